@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+Measure the memory held by the exporter's ClientTable and the allocations
+made by each refresh, at several client counts: by the table update alone,
+and by a whole refresh, which also parses ndsctl output into per-client dicts.
+
+Usage: client-table-benchmark.py [client_count ...]
+"""
+import io
+import sys
+import time
+import tracemalloc
+from fixtures import load_exporter, generate_status
+
+DEFAULT_SIZES = [1000, 10000]
+REFRESHES = 5
+
+def peak_allocation(function):
+    """Peak bytes allocated while function() runs, above what was allocated before"""
+    tracemalloc.reset_peak()
+    before = tracemalloc.get_traced_memory()[0]
+    function()
+    return tracemalloc.get_traced_memory()[1] - before
+
+def benchmark(exporter, num_clients):
+    """
+    Return (retained bytes, peak bytes allocated by one table update, peak
+    bytes allocated by one parse and update, seconds per update, seconds per
+    parse and update)
+    """
+    outputs = [generate_status(num_clients, seed) for seed in range(REFRESHES)]
+    parsed = [exporter.parse_nds_status(io.StringIO(output))[1] for output in outputs]
+
+    tracemalloc.start()
+    table = exporter.ClientTable()
+    table.update(parsed[0], 1.0)
+    retained = tracemalloc.get_traced_memory()[0]
+    update = peak_allocation(lambda: table.update(parsed[1], 2.0))
+    stream = io.StringIO(outputs[2])
+    refresh = peak_allocation(lambda: table.update(exporter.parse_nds_status(stream)[1], 3.0))
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    for seed in range(3, REFRESHES):
+        table.update(parsed[seed], float(seed + 1))
+    update_time = (time.perf_counter() - start) / (REFRESHES - 3)
+    start = time.perf_counter()
+    for seed in range(3, REFRESHES):
+        table.update(exporter.parse_nds_status(io.StringIO(outputs[seed]))[1], float(seed + 10))
+    refresh_time = (time.perf_counter() - start) / (REFRESHES - 3)
+    return retained, update, refresh, update_time, refresh_time
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES
+    exporter = load_exporter()
+
+    print(f"{'clients':>8} {'table KiB':>10} {'B/client':>9} {'update KiB':>11} {'refresh KiB':>12} "
+          f"{'update ms':>10} {'refresh ms':>11}")
+    for num_clients in sizes:
+        retained, update, refresh, update_time, refresh_time = benchmark(exporter, num_clients)
+        print(f"{num_clients:>8} {retained / 1024:>10.1f} {retained / num_clients:>9.0f} {update / 1024:>11.1f} "
+              f"{refresh / 1024:>12.1f} {update_time * 1000:>10.2f} {refresh_time * 1000:>11.2f}")
+
+if __name__ == '__main__':
+    main()
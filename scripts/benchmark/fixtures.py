@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Shared helpers for the exporter benchmarks.
+Builds synthetic ndsctl output and loads the exporter module from the repo tree.
+"""
+import os
+import importlib.util
+
+REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+EXPORTER_PATH = os.path.join(REPO_DIR, 'services', 'opennds-exporter.py')
+
+def load_exporter():
+    """Import services/opennds-exporter.py (the file name is not importable directly)"""
+    spec = importlib.util.spec_from_file_location('opennds_exporter', EXPORTER_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def client_mac(index):
+    """Deterministic MAC address for synthetic client number index"""
+    return 'aa:bb:' + ':'.join(f"{(index >> shift) & 0xff:02x}" for shift in (24, 16, 8, 0))
+
+def client_ip(index):
+    """Deterministic IP address for synthetic client number index"""
+    return f"10.{(index >> 16) & 0xff}.{(index >> 8) & 0xff}.{index & 0xff}"
+
+def generate_status(num_clients, seed=0):
+    """
+    Build ndsctl status text for num_clients clients.
+    seed shifts the byte counters so consecutive calls look like traffic.
+    """
+    # Both spellings: openNDS prints 'kByte', older releases 'kB'
+    units = ['B', 'kB', 'kByte', 'MByte', 'MB', 'GB']
+    lines = [
+        '==================',
+        'OpenNDS Status',
+        '====',
+        'Version: 10.2.0',
+        'Uptime: 1d 2h 3m 4s',
+        'Gateway Name: openNDS',
+        'Managed interface: br-lan',
+        f"Total download: {123456.78 + seed * 100:.2f} kByte; avg: 12.3 kbit/s",
+        f"Total upload: {2345.00 + seed * 10:.2f} kB; avg: 1.2 kbit/s",
+        '====',
+        f"Client authentications since start: {num_clients}",
+        f"Current clients: {num_clients}",
+        ''
+    ]
+    for index in range(num_clients):
+        unit = units[index % len(units)]
+        lines.extend([
+            f"Client {index}",
+            '  Client Type: cpd_can',
+            f"  IP: {client_ip(index)} MAC: {client_mac(index)}",
+            '  Last Activity: Tue Oct  1 12:00:00 2024 (5 seconds ago)',
+            '  Session Start: Tue Oct  1 11:00:00 2024 (3605 seconds ago)',
+            '  Session End: Never',
+            f"  Token: {index:08x}",
+            f"  State: {'Authenticated' if index % 5 else 'Preauthenticated'}",
+            '  Download rate limit: 0 kbit/s',
+            '  Upload rate limit: 0 kbit/s',
+            f"  Download this session: {(index % 997) + seed + 0.5:.2f} {unit}; session avg: 12.34 kbit/s",
+            f"  Upload this session: {(index % 97) + seed + 0.25:.2f} {unit}; session avg: 2.34 kbit/s",
+            ''
+        ])
+    lines.append('====')
+    return '\n'.join(lines) + '\n'
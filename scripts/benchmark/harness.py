@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for GitHub and the router, for exercising update-checker.py
+without network access, docker or opennds.
+
+FakeGitHub serves the git tree API and raw file endpoints the checker uses
+from an in-memory repository and counts requests and bytes. prepare_base_dir
+builds a temporary monitoring directory with stub update-executor.sh, handler,
+docker, docker-compose and exporter init script commands that record their calls.
+
+Run directly to serve this repository's files and print the command that
+points a checker at them:
+
+Usage: harness.py [--port PORT] [--updates M] [--no-backup-store]
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import tempfile
+import threading
+import importlib.util
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from fixtures import REPO_DIR
+
+CHECKER_PATH = os.path.join(REPO_DIR, 'scripts', 'update', 'update-checker.py')
+RATE_LIMIT = 5000  # Requests per hour GitHub allows an authenticated client
+RATE_LIMIT_WINDOW = 3600  # Seconds until GitHub resets the remaining count
+
+# Stub for the checker's update-executor.sh: records its arguments and, like
+# the real executor, marks every numbered update in updates/ as executed
+EXECUTOR_STUB = '''#!/bin/sh
+echo "executor $*" >> "$MONITORING_BASE_DIR/calls.log"
+last=$(cat "$MONITORING_BASE_DIR/state/last_update")
+for update in "$MONITORING_BASE_DIR"/updates/update*; do
+    [ -e "$update" ] || continue
+    number=${update##*/update}
+    [ "$number" -gt "$last" ] && last=$number
+done
+echo "$last" > "$MONITORING_BASE_DIR/state/last_update"
+'''
+
+# Stub for docker, docker-compose, the executor handler and the exporter's init script
+COMMAND_STUB = '''#!/bin/sh
+echo "{name} $*" >> "$MONITORING_BASE_DIR/calls.log"
+[ "$1" = "ps" ] && echo "prometheus   Up"
+[ "$1" = "status" ] && echo "running"
+exit 0
+'''
+
+def git_blob_sha(content):
+    """SHA GitHub reports for a blob with this content"""
+    return hashlib.sha1(f"blob {len(content)}\0".encode() + content).hexdigest()
+
+class FakeGitHubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        github = self.server.github
+        path = self.path.split('?', 1)[0]
+        if path == f"/api/git/trees/{github.branch}":
+            self.send_tree(github.tree(), github.etag())
+        elif path.startswith('/api/git/trees/'):
+            self.send_tree(github.subtree(path[len('/api/git/trees/'):]))
+        elif path.startswith('/raw/'):
+            self.send_raw(path[len('/raw/'):])
+        else:
+            self.send_body(404, b'{"message": "Not Found"}')
+
+    def send_tree(self, tree, etag=None):
+        if tree is None:
+            self.send_body(404, b'{"message": "Not Found"}')
+        elif etag and self.headers.get('If-None-Match') == etag:
+            # Like GitHub, conditional hits don't count against the rate limit
+            self.send_body(304, b'', {'ETag': etag}, rate_limited=False)
+        else:
+            headers = {'ETag': etag, 'Content-Type': 'application/json'} if etag else {}
+            self.send_body(200, json.dumps(tree).encode(), headers)
+
+    def send_raw(self, path):
+        content = self.server.github.files.get(path)
+        if content is None:
+            self.send_body(404, b'404: Not Found', rate_limited=False)
+            return
+        requested = self.headers.get('Range', '')
+        if requested.startswith('bytes=') and requested.endswith('-'):
+            offset = int(requested[len('bytes='):-1])
+            headers = {'Content-Range': f"bytes {offset}-{len(content) - 1}/{len(content)}"}
+            self.send_body(206, content[offset:], headers, rate_limited=False)
+        else:
+            self.send_body(200, content, rate_limited=False)
+
+    def send_body(self, status, body, headers=None, rate_limited=True):
+        github = self.server.github
+        with github.lock:
+            if time.time() >= github.reset_at:
+                github.remaining = RATE_LIMIT
+                github.reset_at = int(time.time()) + RATE_LIMIT_WINDOW
+            if rate_limited and status != 304:
+                github.remaining = max(0, github.remaining - 1)
+            github.requests[self.path.split('?', 1)[0].split('/')[1]] += 1
+            github.bytes_sent += len(body)
+            remaining = github.remaining
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if rate_limited:
+            self.send_header('X-RateLimit-Limit', str(RATE_LIMIT))
+            self.send_header('X-RateLimit-Remaining', str(remaining))
+            self.send_header('X-RateLimit-Reset', str(github.reset_at))
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class FakeGitHub:
+    """
+    In-process GitHub stand-in serving files from a {path: bytes} dict.
+    /api/git/trees/<branch> lists the repository (with ETag revalidation),
+    /api/git/trees/<sha> lists the updates/ subtree and /raw/<path> serves
+    file content with Range support. Set tree_limit to make the recursive
+    listing come back truncated, as GitHub does for very large trees.
+    """
+
+    def __init__(self, files=None, port=0, tree_limit=None):
+        self.files = dict(files or {})
+        self.branch = 'main'
+        self.tree_limit = tree_limit
+        self.lock = threading.Lock()
+        self.requests = Counter()  # Requests per endpoint ('api' or 'raw')
+        self.bytes_sent = 0
+        self.remaining = RATE_LIMIT
+        self.reset_at = int(time.time()) + RATE_LIMIT_WINDOW
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), FakeGitHubHandler)
+        self.server.daemon_threads = True
+        self.server.github = self
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    @property
+    def raw_base(self):
+        return f"{self.url}/raw"
+
+    @property
+    def api_base(self):
+        return f"{self.url}/api"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset_stats(self):
+        with self.lock:
+            self.requests.clear()
+            self.bytes_sent = 0
+
+    def updates_tree_sha(self):
+        listing = ''.join(f"{path} {git_blob_sha(content)}\n" for path, content in sorted(self.files.items())
+                          if path.startswith('updates/'))
+        return hashlib.sha1(listing.encode()).hexdigest()
+
+    def etag(self):
+        listing = ''.join(f"{path} {git_blob_sha(content)}\n" for path, content in sorted(self.files.items()))
+        return f'"{hashlib.sha1(listing.encode()).hexdigest()}"'
+
+    def tree(self):
+        entries = [{'path': 'updates', 'type': 'tree', 'sha': self.updates_tree_sha()}]
+        entries += [{'path': path, 'type': 'blob', 'sha': git_blob_sha(content), 'size': len(content)}
+                    for path, content in sorted(self.files.items())]
+        truncated = self.tree_limit is not None and len(entries) > self.tree_limit
+        return {'sha': self.etag().strip('"'), 'tree': entries[:self.tree_limit], 'truncated': truncated}
+
+    def subtree(self, sha):
+        if sha != self.updates_tree_sha():
+            return None
+        entries = [{'path': path[len('updates/'):], 'type': 'blob', 'sha': git_blob_sha(content), 'size': len(content)}
+                   for path, content in sorted(self.files.items()) if path.startswith('updates/')]
+        return {'sha': sha, 'tree': entries, 'truncated': False}
+
+def repo_files(paths):
+    """Read files from this repository as {path: bytes}"""
+    files = {}
+    for path in paths:
+        with open(os.path.join(REPO_DIR, path), 'rb') as f:
+            files[path] = f.read()
+    return files
+
+def update_script(number):
+    """Content of a synthetic numbered update script"""
+    return f"#!/bin/sh\n# Update {number}\necho update {number}\n".encode()
+
+def prepare_base_dir(base_dir, github):
+    """
+    Lay out a monitoring base directory with stubbed commands and return the
+    environment variables that point a checker at it and at github.
+    """
+    for directory in ['state', 'updates', 'update-system', 'bin']:
+        os.makedirs(os.path.join(base_dir, directory), exist_ok=True)
+    with open(os.path.join(base_dir, 'state', 'last_update'), 'w') as f:
+        f.write('0\n')
+
+    stubs = {
+        'update-executor.sh': EXECUTOR_STUB,
+        'update-executor-handler.py': COMMAND_STUB.format(name='handler'),
+        'bin/docker': COMMAND_STUB.format(name='docker'),
+        'bin/docker-compose': COMMAND_STUB.format(name='docker-compose'),
+        'bin/opennds-exporter': COMMAND_STUB.format(name='opennds-exporter')
+    }
+    for name, script in stubs.items():
+        path = os.path.join(base_dir, name)
+        with open(path, 'w') as f:
+            f.write(script)
+        os.chmod(path, 0o755)
+
+    return {
+        'MONITORING_BASE_DIR': base_dir,
+        'UPDATE_RAW_BASE': github.raw_base,
+        'UPDATE_API_BASE': github.api_base,
+        'UPDATE_LOG_FILE': os.path.join(base_dir, 'update-checker.log'),
+        'EXPORTER_SERVICE': os.path.join(base_dir, 'bin', 'opennds-exporter'),
+        'PATH': os.path.join(base_dir, 'bin') + os.pathsep + os.environ.get('PATH', '')
+    }
+
+def load_checker(env):
+    """Import scripts/update/update-checker.py configured by env (from prepare_base_dir)"""
+    os.environ.update(env)
+    spec = importlib.util.spec_from_file_location('update_checker', CHECKER_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def install_core_files(checker, files, missing=()):
+    """
+    Put repository content at each core file's local path, as on a freshly set
+    up router. Paths in missing are left out, as on a router set up before
+    they were added.
+    """
+    for github_path, local_path in checker.CORE_FILES.items():
+        if github_path in files and github_path not in missing:
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            with open(local_path, 'wb') as f:
+                f.write(files[github_path])
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve this repository as a fake GitHub for update-checker.py")
+    parser.add_argument('--port', type=int, default=8780)
+    parser.add_argument('--updates', type=int, default=3, metavar='M', help="numbered update scripts to serve")
+    parser.add_argument('--no-backup-store', action='store_true',
+                        help="leave backup-store.py out of the base directory, like routers set up before it existed")
+    args = parser.parse_args()
+
+    github = FakeGitHub(port=args.port)
+    base_dir = tempfile.mkdtemp(prefix='update-harness-')
+    env = prepare_base_dir(base_dir, github)
+    checker = load_checker(env)
+    github.files = repo_files(checker.CORE_FILES)
+    github.files.update({f"updates/update{number}": update_script(number) for number in range(1, args.updates + 1)})
+    install_core_files(checker, github.files, ['scripts/update/backup-store.py'] if args.no_backup_store else ())
+
+    print(f"Serving {len(github.files)} files at {github.url}, base directory {base_dir}")
+    print("Run the checker against it with:")
+    print(' '.join(f"{name}={value}" for name, value in env.items()) + f" python3 {CHECKER_PATH}")
+    sys.stdout.flush()
+    try:
+        github.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""
+Benchmark the ndsctl status parser against synthetic output.
+Reports parse time and peak memory for a range of client counts.
+
+Usage: parser-benchmark.py [client_count ...]
+"""
+import io
+import sys
+import time
+import tracemalloc
+from fixtures import load_exporter, generate_status
+
+DEFAULT_SIZES = [100, 1000, 5000, 10000]
+REPEATS = 5
+
+def benchmark(exporter, num_clients):
+    """Return (best parse seconds, peak traced bytes) for num_clients clients"""
+    output = generate_status(num_clients)
+
+    best = None
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        _, clients = exporter.parse_nds_status(io.StringIO(output))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    assert len(clients) == num_clients
+
+    # Measure memory separately so tracing overhead doesn't skew the timings
+    stream = io.StringIO(output)
+    tracemalloc.start()
+    exporter.parse_nds_status(stream)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES
+    exporter = load_exporter()
+
+    print(f"{'clients':>8} {'parse ms':>10} {'us/client':>10} {'peak KiB':>10}")
+    for num_clients in sizes:
+        elapsed, peak = benchmark(exporter, num_clients)
+        print(f"{num_clients:>8} {elapsed * 1000:>10.2f} {elapsed * 1e6 / num_clients:>10.2f} {peak / 1024:>10.1f}")
+
+if __name__ == '__main__':
+    main()
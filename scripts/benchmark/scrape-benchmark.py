@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Compare /metrics scrapes served by prometheus_client's WSGI app, which renders
+(and gzips) the whole registry on every request, with the exporter's
+exposition cache, which the refresher re-renders after every refresh.
+
+The refresh interval is about the same as Prometheus's scrape interval, so
+the "refreshed" rows run a refresh before every scrape, as Prometheus sees
+it; refresh time is not counted as scrape time. The other rows scrape
+repeatedly between refreshes, as several scrapers or a curl would.
+
+Server CPU is process time over the scrapes; client and server share the
+process, but the client only reads bytes, so the difference is the server's.
+
+Usage: scrape-benchmark.py [client_count ...]
+"""
+import os
+import sys
+import time
+import tempfile
+import threading
+import http.client
+from wsgiref.simple_server import make_server
+from prometheus_client import CollectorRegistry, make_wsgi_app
+from fixtures import load_exporter, generate_status
+
+DEFAULT_SIZES = [1000, 10000]
+SCRAPES = 20
+# What Prometheus sends when scraping
+SCRAPE_HEADERS = {
+    'Accept': 'application/openmetrics-text;version=1.0.0,application/openmetrics-text;version=0.0.1;q=0.75,'
+              'text/plain;version=0.0.4;q=0.5,*/*;q=0.1',
+    'Accept-Encoding': 'gzip'
+}
+
+def serve(exporter, app):
+    server = make_server('127.0.0.1', 0, app, exporter.ThreadingWSGIServer, handler_class=exporter.QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def scrape(port, headers):
+    """One scrape; returns (status, ETag, bytes received)"""
+    connection = http.client.HTTPConnection('127.0.0.1', port)
+    connection.request('GET', '/metrics', headers=headers)
+    response = connection.getresponse()
+    body = response.read()
+    connection.close()
+    return response.status, response.getheader('ETag'), len(body)
+
+def benchmark(port, headers, refresher=None):
+    """
+    Return (ms per scrape, slowest scrape ms, CPU ms per scrape, KiB per scrape),
+    refreshing before each scrape if a refresher is given
+    """
+    scrape(port, headers)  # Warm up, and fill the cache where there is one
+    received = elapsed = cpu = slowest = 0
+    for _ in range(SCRAPES):
+        if refresher:
+            refresher.refresh()
+        cpu_start = time.process_time()
+        start = time.perf_counter()
+        received += scrape(port, headers)[2]
+        took = time.perf_counter() - start
+        cpu += time.process_time() - cpu_start
+        elapsed += took
+        slowest = max(slowest, took)
+    return elapsed / SCRAPES * 1000, slowest * 1000, cpu / SCRAPES * 1000, received / SCRAPES / 1024
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES
+    exporter = load_exporter()
+
+    print(f"{'clients':>8} {'server':<22} {'ms/scrape':>10} {'max ms':>8} {'CPU ms':>8} {'KiB':>8}")
+    for num_clients in sizes:
+        with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as capture:
+            capture.write(generate_status(num_clients))
+        refresher = exporter.SnapshotRefresher(exporter.FileSource(capture.name))
+
+        registry = CollectorRegistry()
+        registry.register(exporter.NDSCollector(refresher))
+        uncached = serve(exporter, make_wsgi_app(registry))
+        cached = serve(exporter, exporter.make_exporter_app(refresher, registry))
+        refresher.refresh()
+
+        rows = [
+            ('prometheus_client', uncached.server_port, True, False),
+            ('cached, refreshed', cached.server_port, True, False),
+            ('cached', cached.server_port, False, False),
+            ('cached 304', cached.server_port, False, True)
+        ]
+        for name, port, refreshed, conditional in rows:
+            headers = SCRAPE_HEADERS
+            if conditional:
+                # Fetch the ETag now: a body older than two refresh intervals is re-rendered
+                headers = dict(SCRAPE_HEADERS, **{'If-None-Match': scrape(port, SCRAPE_HEADERS)[1]})
+            elapsed, slowest, cpu, size = benchmark(port, headers, refresher if refreshed else None)
+            print(f"{num_clients:>8} {name:<22} {elapsed:>10.2f} {slowest:>8.2f} {cpu:>8.2f} {size:>8.1f}")
+
+        # What the refresher pays once per refresh instead of once per scrape
+        start = time.perf_counter()
+        refresher.refresh()
+        elapsed = time.perf_counter() - start
+        print(f"{num_clients:>8} {'refresh':<22} {elapsed * 1000:>10.2f}")
+        print(f"{num_clients:>8} {'  of which render+gzip':<22} {refresher.render_duration * 1000:>10.2f}")
+
+        uncached.shutdown()
+        cached.shutdown()
+        os.remove(capture.name)
+
+if __name__ == '__main__':
+    main()
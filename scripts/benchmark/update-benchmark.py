@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Measure update-checker cycles end to end against the local fake GitHub:
+latency, API and raw requests, bytes transferred and peak Python memory,
+with N extra core files and M numbered update scripts.
+
+With --bootstrap the router starts without backup-store.py, as routers set
+up before it existed do, and the cold cycle has to install it.
+
+Usage: update-benchmark.py [--core N] [--updates M] [--size BYTES] [--bootstrap]
+"""
+import os
+import time
+import logging
+import argparse
+import tempfile
+import tracemalloc
+from harness import FakeGitHub, prepare_base_dir, load_checker, repo_files, install_core_files, update_script
+
+def bench_file(index, version, size):
+    """Content of synthetic core file number index at a given version"""
+    line = f"# bench file {index} version {version}\n".encode()
+    return (line * (size // len(line) + 1))[:size]
+
+def add_core_files(checker, github, count, size):
+    """Register count synthetic config files, installed the way the Prometheus config is"""
+    paths = []
+    for index in range(count):
+        path = f"config/bench-{index}.conf"
+        checker.CORE_FILES[path] = f"{checker.LOCAL_BASE_DIR}/bench/{index}.conf"
+        checker.UPDATE_ORDER.append(path)
+        github.files[path] = bench_file(index, 0, size)
+        paths.append(path)
+
+    plan = checker.plan_core_updates
+    checker.plan_core_updates = lambda staged: [('install', path, ()) for path in paths if path in staged] + plan(staged)
+    return paths
+
+def run_cycle(checker, github):
+    """Run one check cycle; returns (seconds, API requests, raw requests, bytes, peak bytes)"""
+    github.reset_stats()
+    tracemalloc.start()
+    start = time.perf_counter()
+    checker.check_for_updates()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, github.requests['api'], github.requests['raw'], github.bytes_sent, peak
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--core', type=int, default=20, metavar='N', help="extra core files")
+    parser.add_argument('--updates', type=int, default=200, metavar='M', help="numbered update scripts")
+    parser.add_argument('--size', type=int, default=16 * 1024, help="bytes per extra core file")
+    parser.add_argument('--bootstrap', action='store_true', help="start without backup-store.py installed")
+    args = parser.parse_args()
+
+    github = FakeGitHub().start()
+    with tempfile.TemporaryDirectory(prefix='update-benchmark-') as base_dir:
+        checker = load_checker(prepare_base_dir(base_dir, github))
+        checker.logger.setLevel(logging.WARNING)
+        github.files = repo_files(checker.CORE_FILES)
+        paths = add_core_files(checker, github, args.core, args.size)
+        install_core_files(checker, github.files, ['scripts/update/backup-store.py'] if args.bootstrap else ())
+
+        def change_everything():
+            for index, path in enumerate(paths):
+                github.files[path] = bench_file(index, 1, args.size)
+            github.files.update({f"updates/update{number}": update_script(number)
+                                 for number in range(1, args.updates + 1)})
+
+        scenarios = [
+            ('cold', None),  # Empty caches, nothing to update
+            ('idle', None),  # Tree unchanged, answered with 304
+            ('update all', change_everything),
+            ('idle', None),
+            ('one new update', lambda: github.files.update({f"updates/update{args.updates + 1}":
+                                                            update_script(args.updates + 1)}))
+        ]
+
+        print(f"{len(checker.CORE_FILES)} core files ({args.core} x {args.size} B extra), {args.updates} updates")
+        print(f"{'cycle':<16} {'ms':>9} {'api':>5} {'raw':>5} {'KiB sent':>10} {'peak KiB':>10}")
+        for name, change in scenarios:
+            if change:
+                change()
+            elapsed, api, raw, sent, peak = run_cycle(checker, github)
+            print(f"{name:<16} {elapsed * 1000:>9.1f} {api:>5} {raw:>5} {sent / 1024:>10.1f} {peak / 1024:>10.1f}")
+        if not os.path.exists(checker.BACKUP_STORE):
+            print("backup-store.py was not installed")
+    github.stop()
+
+if __name__ == '__main__':
+    main()
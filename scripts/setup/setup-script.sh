@@ -96,6 +96,9 @@ chmod 755 /usr/local/monitoring/update-system/executor.sh
 wget https://raw.githubusercontent.com/yaswanthsk04/guesthub_v0.1.0/main/scripts/update/update-executor-handler.py -O /usr/local/monitoring/update-system/executor-handler.py
 chmod 755 /usr/local/monitoring/update-system/executor-handler.py
 
+wget https://raw.githubusercontent.com/yaswanthsk04/guesthub_v0.1.0/main/scripts/update/backup-store.py -O /usr/local/monitoring/update-system/backup-store.py
+chmod 755 /usr/local/monitoring/update-system/backup-store.py
+
 wget https://raw.githubusercontent.com/yaswanthsk04/guesthub_v0.1.0/main/scripts/update/monitor-update-checker.sh -O /usr/local/monitoring/update-system/monitor.sh
 chmod 755 /usr/local/monitoring/update-system/monitor.sh
 
@@ -0,0 +1,372 @@
+#!/usr/bin/python3
+"""
+Content-addressed backup store for files replaced by the update system.
+
+Each distinct file content is stored once under backups/objects/, named by
+its SHA-256. A small append-only index records which content a path had at
+which time, so repeated backups of an unchanged file cost one index line.
+
+A rollback holds back the version it replaced: the update checker won't
+install that version again until the repository has a different one, or
+the hold is released. The service that runs from the file is restarted.
+
+Usage:
+    backup-store.py save [--link] <path>
+    backup-store.py list <path>
+    backup-store.py rollback <path> [--to N] [--no-restart]
+    backup-store.py release <path>
+    backup-store.py gc
+"""
+import os
+import sys
+import time
+import fcntl
+import json
+import shutil
+import hashlib
+import logging
+import subprocess
+import argparse
+from datetime import datetime
+from contextlib import contextmanager
+
+# Setup logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='[%(asctime)s] backup-store: %(levelname)s - %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S',
+    handlers=[
+        logging.FileHandler(os.environ.get('UPDATE_LOG_FILE', '/var/log/update-checker.log')),
+        logging.StreamHandler(sys.stdout)
+    ]
+)
+
+BASE_DIR = os.environ.get('MONITORING_BASE_DIR', "/usr/local/monitoring")
+BACKUPS_DIR = f"{BASE_DIR}/backups"
+OBJECTS_DIR = f"{BACKUPS_DIR}/objects"
+INDEX_FILE = f"{BACKUPS_DIR}/index"  # One "timestamp sha256 path" line per backup
+LOCK_FILE = f"{BACKUPS_DIR}/.lock"
+# Versions the update checker must not reinstall: path -> git blob SHA
+HOLDS_FILE = f"{BASE_DIR}/state/holds.json"
+
+KEEP_VERSIONS = 5  # Most backups kept per path
+RETENTION_DAYS = 30  # Older backups are dropped, except the newest one per path
+
+FICLONE = 0x40049409  # Linux ioctl that shares file extents copy-on-write (reflink)
+HASH_CHUNK_SIZE = 64 * 1024
+
+# What a rollback runs around the restore for files a service runs from:
+# path -> (commands before, commands after). The compose stack goes down
+# with the file it was started from.
+COMPOSE_FILE = f"{BASE_DIR}/docker/docker-compose.yml"
+SERVICE_COMMANDS = {
+    f"{BASE_DIR}/exporters/opennds.py": (
+        [], [[os.environ.get('EXPORTER_SERVICE', "/etc/init.d/opennds-exporter"), 'restart']]),
+    f"{BASE_DIR}/update-system/checker.py": ([], [["/etc/init.d/update-checker", 'restart']]),
+    f"{BASE_DIR}/docker/prometheus/config.yml": ([], [['docker', 'kill', '--signal', 'HUP', 'prometheus']]),
+    COMPOSE_FILE: ([['docker-compose', '-f', COMPOSE_FILE, 'down']],
+                   [['docker-compose', '-f', COMPOSE_FILE, 'up', '-d']])
+}
+
+@contextmanager
+def store_lock():
+    """Serialise store changes between the checker, executor and handler"""
+    os.makedirs(BACKUPS_DIR, exist_ok=True)
+    with open(LOCK_FILE, 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+def file_digest(path):
+    """SHA-256 of a file's content"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def git_blob_sha(path):
+    """SHA git (and the update checker's manifest) gives a file's content"""
+    with open(path, 'rb') as f:
+        content = f.read()
+    digest = hashlib.sha1(f"blob {len(content)}\0".encode())
+    digest.update(content)
+    return digest.hexdigest()
+
+def object_path(digest):
+    return f"{OBJECTS_DIR}/{digest[:2]}/{digest[2:]}"
+
+def fsync_dir(path):
+    """Flush a directory entry change (rename, link) to disk"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def clone_file(src, dst):
+    """
+    Copy src to dst, sharing extents with a reflink where the filesystem
+    supports it so no data blocks are written, and falling back to a copy.
+    """
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            shutil.copyfileobj(fsrc, fdst, HASH_CHUNK_SIZE)
+        fdst.flush()
+        os.fsync(fdst.fileno())
+    shutil.copymode(src, dst)
+
+def store_object(path, digest, link=False):
+    """
+    Add a file's content to the object store unless it is already there.
+    With link, the object is a hardlink to the file, which costs no writes but
+    is only safe when the caller is about to replace the file with os.replace
+    rather than overwrite it in place.
+    """
+    obj = object_path(digest)
+    if os.path.exists(obj):
+        return
+    os.makedirs(os.path.dirname(obj), exist_ok=True)
+    tmp = f"{obj}.tmp"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    if link:
+        try:
+            os.link(path, tmp)
+        except OSError:
+            link = False  # e.g. the file is on another filesystem
+    if not link:
+        clone_file(path, tmp)
+    os.replace(tmp, obj)
+    fsync_dir(os.path.dirname(obj))
+
+def read_index():
+    """All backups as (timestamp, digest, path), oldest first"""
+    entries = []
+    try:
+        with open(INDEX_FILE, 'r') as f:
+            for line in f:
+                parts = line.rstrip('\n').split(' ', 2)
+                if len(parts) == 3:
+                    entries.append((int(parts[0]), parts[1], parts[2]))
+    except FileNotFoundError:
+        pass
+    return entries
+
+def write_index(entries):
+    """Atomically replace the index"""
+    tmp = f"{INDEX_FILE}.tmp"
+    with open(tmp, 'w') as f:
+        f.writelines(f"{timestamp} {digest} {path}\n" for timestamp, digest, path in entries)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, INDEX_FILE)
+    fsync_dir(BACKUPS_DIR)
+
+def read_holds():
+    try:
+        with open(HOLDS_FILE, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def write_holds(holds):
+    """Atomically replace the holds file. Must be called with the store lock held."""
+    os.makedirs(os.path.dirname(HOLDS_FILE), exist_ok=True)
+    tmp = f"{HOLDS_FILE}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(holds, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, HOLDS_FILE)
+
+def release(path):
+    """Let the update checker install whatever version the repository has again"""
+    path = os.path.abspath(path)
+    with store_lock():
+        holds = read_holds()
+        if holds.pop(path, None) is None:
+            return False
+        write_holds(holds)
+    logging.info(f"Released hold on {path}")
+    return True
+
+def history(path):
+    """Backups of a path as (timestamp, digest), newest first"""
+    path = os.path.abspath(path)
+    return [(timestamp, digest) for timestamp, digest, entry_path in reversed(read_index()) if entry_path == path]
+
+def record_backup(path, link=False):
+    """
+    Back up a file's current content and return its digest.
+    Must be called with the store lock held.
+    """
+    path = os.path.abspath(path)
+    digest = file_digest(path)
+    versions = history(path)
+    if versions and versions[0][1] == digest:
+        # Unchanged since the last backup, so there's nothing new to record
+        return digest
+    store_object(path, digest, link)
+    with open(INDEX_FILE, 'a') as f:
+        f.write(f"{int(time.time())} {digest} {path}\n")
+        f.flush()
+        os.fsync(f.fileno())
+    collect_garbage()
+    logging.info(f"Backed up {path} as {digest[:12]}")
+    return digest
+
+def save(path, link=False):
+    """Back up a file's current content. Returns its digest."""
+    with store_lock():
+        return record_backup(path, link)
+
+def run_service_commands(commands):
+    """Run service commands in order; returns True if all succeeded"""
+    ok = True
+    for args in commands:
+        try:
+            subprocess.run(args, check=True, timeout=900)
+        except (OSError, subprocess.SubprocessError) as e:
+            logging.error(f"{' '.join(args)} failed: {e}")
+            ok = False
+    return ok
+
+def rollback(path, to=1, restart=True):
+    """
+    Restore the Nth most recent backup of a path (1 = latest) from the local
+    store. The content being replaced is backed up first, so a rollback can
+    itself be undone with another rollback, and held, so the update checker
+    doesn't reinstall it on its next check. With restart, the service that
+    runs from the file is restarted or reloaded.
+    """
+    path = os.path.abspath(path)
+    available = len(history(path))
+    if not 1 <= to <= available:
+        logging.error(f"No backup {to} of {path} ({available} available)")
+        return False
+    before, after = SERVICE_COMMANDS.get(path, ([], [])) if restart else ([], [])
+    stopped = run_service_commands(before)
+    with store_lock():
+        restored = stopped and restore_backup(path, to)
+    # A service stopped for the restore comes back either way
+    started = run_service_commands(after) if restored or before else True
+    return restored and started
+
+def restore_backup(path, to):
+    """Rollback of an absolute path, with the store lock held"""
+    versions = history(path)
+    if not 1 <= to <= len(versions):
+        logging.error(f"No backup {to} of {path} ({len(versions)} available)")
+        return False
+    timestamp, digest = versions[to - 1]
+    obj = object_path(digest)
+    if not os.path.exists(obj):
+        logging.error(f"Backup object {digest[:12]} for {path} is missing")
+        return False
+
+    # Stage the restored copy first so the rename below is the only change
+    # anyone can observe
+    tmp = f"{path}.rollback"
+    clone_file(obj, tmp)
+    if os.path.exists(path):
+        record_backup(path, link=True)
+        holds = read_holds()
+        holds[path] = git_blob_sha(path)
+        write_holds(holds)
+    os.replace(tmp, path)
+    fsync_dir(os.path.dirname(path))
+    logging.info(f"Restored {path} to backup from {datetime.fromtimestamp(timestamp):%Y-%m-%d %H:%M:%S}")
+    return True
+
+def collect_garbage(now=None):
+    """
+    Apply the retention policy: per path keep the newest KEEP_VERSIONS backups,
+    dropping any older than RETENTION_DAYS except the newest. Objects no
+    longer referenced by the index are then deleted.
+    Must be called with the store lock held.
+    """
+    now = now or time.time()
+    cutoff = now - RETENTION_DAYS * 86400
+    entries = read_index()
+
+    ranks = {}
+    kept = []
+    for timestamp, digest, path in reversed(entries):
+        rank = ranks.get(path, 0)
+        ranks[path] = rank + 1
+        if rank < KEEP_VERSIONS and (rank == 0 or timestamp >= cutoff):
+            kept.append((timestamp, digest, path))
+    kept.reverse()
+    if len(kept) != len(entries):
+        write_index(kept)
+
+    referenced = {digest for _, digest, _ in kept}
+    removed = 0
+    if os.path.isdir(OBJECTS_DIR):
+        for prefix in os.listdir(OBJECTS_DIR):
+            prefix_dir = f"{OBJECTS_DIR}/{prefix}"
+            for name in os.listdir(prefix_dir):
+                if prefix + name not in referenced:
+                    os.remove(f"{prefix_dir}/{name}")
+                    removed += 1
+            if not os.listdir(prefix_dir):
+                os.rmdir(prefix_dir)
+    if removed or len(kept) != len(entries):
+        logging.info(f"Pruned {len(entries) - len(kept)} backups and {removed} objects")
+    return removed
+
+def list_backups(path):
+    """Print a path's backups, numbered as accepted by rollback --to"""
+    versions = history(path)
+    if not versions:
+        print(f"No backups of {os.path.abspath(path)}")
+    held = read_holds().get(os.path.abspath(path))
+    if held:
+        print(f"Updates to git blob {held[:12]} are held back (release to allow them)")
+    for number, (timestamp, digest) in enumerate(versions, 1):
+        obj = object_path(digest)
+        size = os.path.getsize(obj) if os.path.exists(obj) else 0
+        print(f"{number:3d}  {datetime.fromtimestamp(timestamp):%Y-%m-%d %H:%M:%S}  {digest[:12]}  {size} bytes")
+
+def main():
+    parser = argparse.ArgumentParser(description="Content-addressed backups for the update system")
+    commands = parser.add_subparsers(dest='command', required=True)
+    save_parser = commands.add_parser('save', help="back up a file's current content")
+    save_parser.add_argument('path')
+    save_parser.add_argument('--link', action='store_true',
+                             help="hardlink instead of copying; only when the file is about to be replaced by rename")
+    list_parser = commands.add_parser('list', help="show a file's backups")
+    list_parser.add_argument('path')
+    rollback_parser = commands.add_parser('rollback', help="restore a file from a backup")
+    rollback_parser.add_argument('path')
+    rollback_parser.add_argument('--to', type=int, default=1, metavar='N',
+                                 help="backup number from 'list', 1 = most recent (default)")
+    rollback_parser.add_argument('--no-restart', action='store_true',
+                                 help="don't restart or reload the service that runs from the file")
+    release_parser = commands.add_parser('release', help="let the update checker reinstall a rolled-back version")
+    release_parser.add_argument('path')
+    commands.add_parser('gc', help="apply the retention policy now")
+    args = parser.parse_args()
+
+    try:
+        if args.command == 'save':
+            save(args.path, args.link)
+        elif args.command == 'list':
+            list_backups(args.path)
+        elif args.command == 'rollback':
+            if not rollback(args.path, args.to, not args.no_restart):
+                sys.exit(1)
+        elif args.command == 'release':
+            if not release(args.path):
+                print(f"No hold on {os.path.abspath(args.path)}")
+        elif args.command == 'gc':
+            with store_lock():
+                collect_garbage()
+    except Exception as e:
+        logging.error(f"{args.command} failed: {e}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -2,9 +2,23 @@
 import requests
 import hashlib
 import time
+import json
 import os
+import re
+import glob
+import queue
+import bisect
+import random
+import argparse
+import socketserver
+import atexit
+import signal
 import logging
+import logging.handlers
+import threading
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from datetime import datetime, timedelta
 
 # Setup logging with detailed timestamp format
@@ -19,22 +33,59 @@ logger = logging.getLogger('update-checker')
 logger.setLevel(logging.INFO)
 
 # File handler
-file_handler = logging.FileHandler('/var/log/update-checker.log')
+file_handler = logging.FileHandler(os.environ.get('UPDATE_LOG_FILE', '/var/log/update-checker.log'))
 file_handler.setFormatter(CustomFormatter(datefmt='%Y-%m-%d %H:%M:%S'))
-logger.addHandler(file_handler)
 
 # Console handler
 console_handler = logging.StreamHandler()
 console_handler.setFormatter(CustomFormatter(datefmt='%Y-%m-%d %H:%M:%S'))
-logger.addHandler(console_handler)
+
+# Records are queued and written by a background listener thread, so slow
+# log I/O never blocks an update in progress. SimpleQueue, unlike Queue, can
+# be written to from a signal handler (see flush_logs_and_exit).
+log_queue = queue.SimpleQueue()
+logger.addHandler(logging.handlers.QueueHandler(log_queue))
+log_listener = logging.handlers.QueueListener(log_queue, file_handler, console_handler)
+log_listener.start()
+atexit.register(log_listener.stop)
+
+# Set by the first SIGTERM; the executor sends a second one (init.d stop, then pkill)
+terminating = threading.Event()
+
+def flush_logs_and_exit(signum, frame):
+    """
+    SIGTERM handler. Being killed by a signal skips atexit, which would lose
+    the records still queued, often the last lines before the update executor
+    stopped the service. Write them out first, then exit.
+    """
+    if terminating.is_set():
+        return  # Already flushing or exiting; stopping the listener twice fails
+    terminating.set()
+    atexit.unregister(log_listener.stop)
+    log_listener.stop()
+    raise SystemExit(0)
 
 # Configuration
-GITHUB_RAW_BASE = "https://raw.githubusercontent.com/yaswanthsk04/guesthub_v0.1.0/main"
-LOCAL_BASE_DIR = "/usr/local/monitoring"
-CHECK_INTERVAL = 300  # Check every 5 minutes (safe for GitHub API limits)
+# The endpoints and base directory can be overridden from the environment to
+# run the checker against a local stand-in (see scripts/benchmark/harness.py)
+GITHUB_RAW_BASE = os.environ.get('UPDATE_RAW_BASE', "https://raw.githubusercontent.com/yaswanthsk04/guesthub_v0.1.0/main")
+GITHUB_API_BASE = os.environ.get('UPDATE_API_BASE', "https://api.github.com/repos/yaswanthsk04/guesthub_v0.1.0")
+GITHUB_BRANCH = "main"
+LOCAL_BASE_DIR = os.environ.get('MONITORING_BASE_DIR', "/usr/local/monitoring")
+# Each cycle makes one conditional API request for the repository tree. Unchanged
+# trees return 304, which doesn't count against the 60 requests/hour limit.
+CHECK_INTERVAL = 30
+REQUEST_TIMEOUT = 30  # Seconds before a GitHub request is abandoned
+FETCH_CONCURRENCY = 4  # Core files checked in parallel per cycle
+DOWNLOAD_CHUNK_SIZE = 64 * 1024  # Bytes read at a time when streaming downloads
+COMMAND_TIMEOUT = 900  # Seconds before an update command is killed (docker-compose pulls can be slow)
+MAX_BACKOFF = 900  # Longest wait between checks while GitHub keeps failing
+POLL_JITTER = 0.2  # Random +/- fraction of each wait, so a fleet doesn't poll in lockstep
+RATE_LIMIT_RESERVE = 5  # API requests scheduled checks leave for triggered ones
 
 # Files to monitor in order of update priority
 UPDATE_ORDER = [
+    'scripts/update/backup-store.py',         # 0th: Update the store that backs up replaced files
     'scripts/update/update-executor.sh',      # 1st: Update the tool that handles updates
     'scripts/update/update-checker.py',       # 2nd: Update the checker that finds updates
     'services/opennds-exporter.py',          # 3rd: Update service components
@@ -48,17 +99,206 @@ CORE_FILES = {
     'config/prometheus-config.yml': f'{LOCAL_BASE_DIR}/docker/prometheus/config.yml',
     'services/opennds-exporter.py': f'{LOCAL_BASE_DIR}/exporters/opennds.py',
     'scripts/update/update-checker.py': f'{LOCAL_BASE_DIR}/update-system/checker.py',
-    'scripts/update/update-executor.sh': f'{LOCAL_BASE_DIR}/update-system/executor.sh'
+    'scripts/update/update-executor.sh': f'{LOCAL_BASE_DIR}/update-system/executor.sh',
+    'scripts/update/backup-store.py': f'{LOCAL_BASE_DIR}/update-system/backup-store.py'
 }
 
 # Constants for local paths
 LAST_UPDATE_FILE = f"{LOCAL_BASE_DIR}/state/last_update"
 UPDATES_DIR = f"{LOCAL_BASE_DIR}/updates"
-BACKUPS_DIR = f"{LOCAL_BASE_DIR}/backups"
+UPDATE_PREFIX = 'updates/update'  # Repository path prefix of numbered update scripts
+BACKUP_STORE = CORE_FILES['scripts/update/backup-store.py']
+# Core files added after some routers were set up; fetched when missing locally
+BOOTSTRAP_FILES = ['scripts/update/backup-store.py']
+HTTP_CACHE_FILE = f"{LOCAL_BASE_DIR}/state/http_cache.json"
+HASH_STATE_FILE = f"{LOCAL_BASE_DIR}/state/content_hashes.json"
+# Versions rolled back with the backup store, which owns this file
+HOLDS_FILE = f"{LOCAL_BASE_DIR}/state/holds.json"
+DOCKER_DIR = f"{LOCAL_BASE_DIR}/docker"
+EXPORTER_SERVICE = os.environ.get('EXPORTER_SERVICE', "/etc/init.d/opennds-exporter")
+PROMETHEUS_CONTAINER = "prometheus"
+
+# Docker compose joins progress updates with carriage returns and runs
+# container messages together; split those into separate log lines
+OUTPUT_SPLIT_PATTERN = re.compile(r'\r|(?=container)')
+# Normal docker operations that are logged as info even though they go to stderr
+DOCKER_PROGRESS_PATTERN = re.compile(r'stopping|stopped|removing|removed|starting|started|done', re.IGNORECASE)
+
+# Core files that belong to the docker-compose stack
+DOCKER_FILES = ['config/prometheus-config.yml', 'config/docker-compose.yml']
 
 # Ensure prometheus directory exists
 os.makedirs(f"{LOCAL_BASE_DIR}/prometheus", exist_ok=True)
 
+# One session for all GitHub requests so TLS connections are pooled and reused
+session = requests.Session()
+session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=FETCH_CONCURRENCY))
+
+# Guards the JSON state files, which worker threads may update together
+state_lock = threading.Lock()
+
+def load_http_cache():
+    """Load saved ETag/Last-Modified validators, keyed by URL"""
+    try:
+        with open(HTTP_CACHE_FILE, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        logger.error(f"Ignoring unreadable HTTP cache {HTTP_CACHE_FILE}: {e}")
+        return {}
+
+http_cache = load_http_cache()
+
+def save_http_cache():
+    """Write validators to disk atomically so a crash can't leave a truncated cache"""
+    try:
+        os.makedirs(os.path.dirname(HTTP_CACHE_FILE), exist_ok=True)
+        tmp_path = f"{HTTP_CACHE_FILE}.tmp"
+        with state_lock:
+            with open(tmp_path, 'w') as f:
+                json.dump(http_cache, f)
+            os.replace(tmp_path, HTTP_CACHE_FILE)
+    except Exception as e:
+        logger.error(f"Error saving HTTP cache: {e}")
+
+def load_hash_state():
+    """Load cached content hashes of local files, keyed by GitHub path"""
+    try:
+        with open(HASH_STATE_FILE, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        logger.error(f"Ignoring unreadable hash state {HASH_STATE_FILE}: {e}")
+        return {}
+
+hash_state = load_hash_state()
+
+def load_holds():
+    """Load the versions held back by rollbacks: local path -> git blob SHA"""
+    try:
+        with open(HOLDS_FILE, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        logger.error(f"Ignoring unreadable holds {HOLDS_FILE}: {e}")
+        return {}
+
+def save_hash_state():
+    """Write the content hash state atomically"""
+    try:
+        os.makedirs(os.path.dirname(HASH_STATE_FILE), exist_ok=True)
+        tmp_path = f"{HASH_STATE_FILE}.tmp"
+        with state_lock:
+            with open(tmp_path, 'w') as f:
+                json.dump(hash_state, f)
+            os.replace(tmp_path, HASH_STATE_FILE)
+    except Exception as e:
+        logger.error(f"Error saving hash state: {e}")
+
+def git_blob_sha(content):
+    """Hash bytes the way git hashes a blob, so it can be compared with tree SHAs"""
+    digest = hashlib.sha1(f"blob {len(content)}\0".encode())
+    digest.update(content)
+    return digest.hexdigest()
+
+def local_blob_sha(github_path, local_path):
+    """
+    Return the git blob SHA of a local file, or None if it doesn't exist.
+    The hash is cached in the state file and only recomputed when the
+    file's size or modification time changes.
+    """
+    try:
+        stat = os.stat(local_path)
+    except FileNotFoundError:
+        return None
+
+    entry = hash_state.get(github_path)
+    if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+        return entry['sha']
+
+    with open(local_path, 'rb') as f:
+        sha = git_blob_sha(f.read())
+    with state_lock:
+        hash_state[github_path] = {'sha': sha, 'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+    save_hash_state()
+    return sha
+
+def conditional_headers(url):
+    """Build If-None-Match/If-Modified-Since headers for a URL from the cache"""
+    entry = http_cache.get(url)
+    if not entry:
+        return {}
+
+    headers = {}
+    if entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry.get('last_modified'):
+        headers['If-Modified-Since'] = entry['last_modified']
+    return headers
+
+def is_tracked_path(path):
+    """Whether a repository path is a core file or a numbered update script"""
+    return path in CORE_FILES or path.startswith('updates/')
+
+def fetch_updates_tree(tree_sha):
+    """
+    List the updates/ directory on its own, for when the recursive tree is
+    truncated. Returns {path: {'sha', 'size'}} for the update scripts.
+    """
+    response = session.get(f"{GITHUB_API_BASE}/git/trees/{tree_sha}", timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    tree = response.json()
+    if tree.get('truncated'):
+        logger.error("Updates directory listing was truncated by GitHub")
+    return {f"updates/{item['path']}": {'sha': item['sha'], 'size': item['size']}
+            for item in tree.get('tree', []) if item['type'] == 'blob'}
+
+def fetch_manifest():
+    """
+    Fetch the repository tree in a single request.
+    Returns ({path: {'sha': blob SHA, 'size': bytes}} for core files and update
+    scripts, SHA of the updates/ tree), or (None, None) if it couldn't be fetched.
+    """
+    url = f"{GITHUB_API_BASE}/git/trees/{GITHUB_BRANCH}?recursive=1"
+    try:
+        # Only revalidate if the cached entry holds a manifest in the current format
+        cached = http_cache.get(url, {})
+        headers = conditional_headers(url) if 'updates_tree' in cached else {}
+        response = session.get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+        if response.status_code == 304:
+            return cached['files'], cached['updates_tree']
+        response.raise_for_status()
+
+        tree = response.json()
+        manifest = {item['path']: {'sha': item['sha'], 'size': item['size']} for item in tree.get('tree', [])
+                    if item['type'] == 'blob' and is_tracked_path(item['path'])}
+        updates_tree = next((item['sha'] for item in tree.get('tree', [])
+                             if item['type'] == 'tree' and item['path'] == 'updates'), None)
+        if tree.get('truncated'):
+            # GitHub caps recursive listings, so list updates/ separately
+            logger.warning("Repository tree listing was truncated, listing updates directory separately")
+            if updates_tree is None:
+                raise ValueError("updates directory missing from truncated tree listing")
+            manifest.update(fetch_updates_tree(updates_tree))
+        remember_validators(url, response, files=manifest, updates_tree=updates_tree)
+        return manifest, updates_tree
+    except Exception as e:
+        logger.error(f"Error fetching repository manifest: {e}")
+        return None, None
+
+def remember_validators(url, response, **extra):
+    """Save a response's validators (plus any extra fields) for the next conditional request"""
+    etag = response.headers.get('ETag')
+    last_modified = response.headers.get('Last-Modified')
+    if not etag and not last_modified:
+        return
+    with state_lock:
+        http_cache[url] = {'etag': etag, 'last_modified': last_modified, **extra}
+    save_http_cache()
+
 def ensure_updates_dir():
     """Ensure updates directory exists"""
     os.makedirs(f"{LOCAL_BASE_DIR}/updates", exist_ok=True)
@@ -84,20 +324,79 @@ def set_permissions(filepath):
         logger.error(f"Error setting permissions for {filepath}: {e}")
         return False
 
-def download_file(github_path, local_path):
-    """Download a file from GitHub"""
-    url = f"{GITHUB_RAW_BASE}/{github_path}"
+def fsync_dir(path):
+    """Flush a directory entry so a rename into it survives power loss"""
+    fd = os.open(path, os.O_RDONLY)
     try:
-        response = requests.get(url)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def stream_download(url, local_path, expected=None):
+    """
+    Stream url into local_path atomically.
+    Data goes to a .part file in the same directory, hashed as it arrives,
+    then is fsynced and renamed into place. If a previous attempt at the
+    same version left a .part file behind, the transfer resumes from where
+    it stopped.
+    expected is a manifest entry ({'sha', 'size'}); the download must hash
+    to its git blob SHA or it is discarded and ValueError is raised.
+    """
+    # Part files are named after the version they hold, so a transfer cut
+    # short before the file changed upstream is never resumed
+    part_path = f"{local_path}.{expected['sha']}.part" if expected else f"{local_path}.part"
+    for stale in glob.glob(f"{glob.escape(local_path)}.*part"):
+        if stale != part_path:
+            os.remove(stale)
+    offset = 0
+    if expected and os.path.exists(part_path):
+        offset = os.path.getsize(part_path)
+        if offset >= expected['size']:
+            offset = 0  # Leftover is complete or bogus; start again
+
+    headers = {}
+    if offset:
+        # Ranges must apply to the raw bytes, not a compressed encoding
+        headers = {'Range': f"bytes={offset}-", 'Accept-Encoding': 'identity'}
+
+    digest = hashlib.sha1(f"blob {expected['size']}\0".encode()) if expected else None
+    with session.get(url, headers=headers, stream=True, timeout=REQUEST_TIMEOUT) as response:
         response.raise_for_status()
-        
+        if offset and response.status_code == 206:
+            logger.info(f"Resuming download of {url} at byte {offset}")
+            mode = 'ab'
+            with open(part_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+                    digest.update(chunk)
+        else:
+            mode = 'wb'
+
+        with open(part_path, mode) as f:
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+                if digest:
+                    digest.update(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+
+    if digest and digest.hexdigest() != expected['sha']:
+        os.remove(part_path)
+        # raw.githubusercontent.com can lag behind the API for a few minutes
+        raise ValueError(f"content doesn't match manifest SHA {expected['sha']}")
+
+    os.replace(part_path, local_path)
+    fsync_dir(os.path.dirname(local_path))
+
+def download_file(github_path, local_path, expected=None):
+    """Download a file from GitHub, verifying it against a manifest entry if given"""
+    url = f"{GITHUB_RAW_BASE}/{github_path}"
+    try:
         # Create parent directories if they don't exist
         os.makedirs(os.path.dirname(local_path), exist_ok=True)
         set_permissions(os.path.dirname(local_path))
         
         # Save the file
-        with open(local_path, 'w') as f:
-            f.write(response.text)
+        stream_download(url, local_path, expected)
         
         # Set appropriate permissions
         set_permissions(local_path)
@@ -107,187 +406,500 @@ def download_file(github_path, local_path):
         logger.error(f"Error downloading {github_path}: {e}")
         return False
 
-def check_core_files():
-    """Check and update core configuration files in specific order"""
-    updates_needed = False
-    docker_updates = []  # Track docker-related updates
-    other_updates = []   # Track other updates
+def stage_core_file(github_path, manifest, holds):
+    """
+    Compare one core file with the manifest and, if it changed, download it
+    to a .new file next to the local copy. A version that was rolled back
+    is skipped; once the repository has another one, the hold is released.
+    Returns the .new path, or None if the file is unchanged, held or couldn't be fetched.
+    """
+    local_path = CORE_FILES[github_path]
+    try:
+        remote = manifest.get(github_path)
+        if remote is None:
+            logger.error(f"{github_path} is missing from the repository manifest")
+            return None
+        
+        # Compare content hashes; unchanged files cost no request at all
+        local_sha = local_blob_sha(github_path, local_path)
+        if local_sha is None and github_path not in BOOTSTRAP_FILES:
+            logger.error(f"Local file not found: {local_path}")
+            return None
+        if local_sha == remote['sha']:
+            return None
+        held = holds.get(local_path)
+        if held == remote['sha']:
+            logger.info(f"Skipping {github_path}: this version was rolled back "
+                        f"(backup-store.py release {local_path} to reinstall it)")
+            return None
+        if held is not None:
+            # The store is the only writer of the holds file
+            run_logged(['python3', BACKUP_STORE, 'release', local_path], "Backup store")
+        
+        logger.info(f"Update found for {github_path}")
+        # Stream the verified new version into a temporary file
+        tmp_path = f"{local_path}.new"
+        if not download_file(github_path, tmp_path, remote):
+            return None
+        logger.info(f"Created temporary file at {tmp_path}")
+        return tmp_path
+    except Exception as e:
+        logger.error(f"Error checking {github_path}: {e}")
+        return None
+
+def log_stderr_line(description, line):
+    """Log one stderr line, treating docker progress messages as info"""
+    for part in OUTPUT_SPLIT_PATTERN.split(line):
+        part = part.strip()
+        if not part:
+            continue
+        if DOCKER_PROGRESS_PATTERN.search(part):
+            logger.info(f"Docker compose: {part}")
+        else:
+            logger.error(f"{description} error: {part}")
+
+def run_logged(args, description, cwd=None, timeout=COMMAND_TIMEOUT):
+    """
+    Run a command, logging its output line by line as it arrives.
+    The command is killed if it runs longer than timeout seconds.
+    Returns True if it exited successfully.
+    """
+    start = time.monotonic()
+    expired = threading.Event()
     
-    # Skip if we're in the middle of an update
-    if os.path.exists(f"{LOCAL_BASE_DIR}/update-checker.py.new"):
-        logger.info("Update in progress, skipping check")
-        return
+    def kill():
+        # Kill the whole process group so children holding the pipes die too
+        expired.set()
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+    
+    def drain_stderr():
+        for line in process.stderr:
+            log_stderr_line(description, line)
+    
+    try:
+        process = subprocess.Popen(args, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   text=True, errors='replace', start_new_session=True)
+    except OSError as e:
+        logger.error(f"{description} could not start: {e}")
+        return False
     
-    # First pass: Check all files and prepare updates
-    for github_path in UPDATE_ORDER:
-        local_path = CORE_FILES[github_path]
+    with process:
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+        stderr_thread = threading.Thread(target=drain_stderr, daemon=True)
+        stderr_thread.start()
         try:
-            # Get remote content
-            response = requests.get(f"{GITHUB_RAW_BASE}/{github_path}")
-            response.raise_for_status()
-            remote_content = response.text
-            
-            # Compare with local content
-            try:
-                with open(local_path, 'r') as f:
-                    local_content = f.read()
-                if remote_content != local_content:
-                    logger.info(f"Update found for {github_path}")
-                    # Create temporary file
-                    tmp_path = f"{local_path}.new"
-                    os.makedirs(os.path.dirname(tmp_path), exist_ok=True)
-                    with open(tmp_path, 'w') as f:
-                        f.write(remote_content)
-                    logger.info(f"Created temporary file at {tmp_path}")
-                    
-                    # Handle executor update separately
-                    if github_path == 'scripts/update/update-executor.sh':
-                        logger.info("Handling executor update directly...")
-                        result = subprocess.run(
-                            ['python3', f"{LOCAL_BASE_DIR}/update-executor-handler.py", tmp_path],
-                            capture_output=True,
-                            text=True
-                        )
-                        if result.stdout:
-                            logger.info(f"Handler output: {result.stdout}")
-                        if result.stderr:
-                            logger.error(f"Handler error: {result.stderr}")
-                        if result.returncode != 0:
-                            logger.error("Failed to update executor")
-                    else:
-                        # Group other updates
-                        if github_path in ['config/docker-compose.yml', 'config/prometheus-config.yml']:
-                            docker_updates.append(tmp_path)
-                        else:
-                            other_updates.append(tmp_path)
-                    
-                    updates_needed = True
-            except FileNotFoundError:
-                logger.error(f"Local file not found: {local_path}")
-        except Exception as e:
-            logger.error(f"Error checking {github_path}: {e}")
+            for line in process.stdout:
+                line = line.rstrip()
+                if line:
+                    logger.info(f"{description} output: {line}")
+            stderr_thread.join()
+            process.wait()
+        finally:
+            timer.cancel()
+    
+    duration = time.monotonic() - start
+    if expired.is_set():
+        logger.error(f"{description} timed out after {timeout}s and was killed")
+        return False
+    if process.returncode != 0:
+        logger.error(f"{description} failed with exit code {process.returncode} after {duration:.1f}s")
+        return False
+    logger.info(f"{description} finished in {duration:.1f}s")
+    return True
+
+def plan_core_updates(staged):
+    """
+    Work out the smallest set of service actions for the core files changed
+    this cycle. staged maps GitHub path -> staged .new file for each change.
+    Returns a list of (action, argument, requires) steps in execution order,
+    where requires lists the (action, argument) steps at least one of which
+    must succeed for the step to run (empty means always):
+    - a compose change means one stack down/up, which also picks up any
+      Prometheus config change; the stack goes down before the new files are
+      installed so docker-compose removes the containers the old file created
+    - a Prometheus config change on its own only needs a hot reload
+    - the exporter is restarted only when the exporter itself changed
+    """
+    plan = []
+    # The backup store goes first so every later step backs up through the new version
+    if 'scripts/update/backup-store.py' in staged:
+        plan.append(('install', 'scripts/update/backup-store.py', ()))
+    if 'scripts/update/update-executor.sh' in staged:
+        plan.append(('replace_executor', staged['scripts/update/update-executor.sh'], ()))
     
-    # Second pass: Execute updates in proper order
-    if docker_updates:
-        # If we have docker-related updates, handle them together
-        logger.info("Processing docker-related updates together...")
-        for update_file in docker_updates:
-            result = subprocess.run(
-                [f"{LOCAL_BASE_DIR}/update-executor.sh", update_file, "--batch"],
-                capture_output=True,
-                text=True
-            )
-            if result.stdout:
-                logger.info(f"Update executor output: {result.stdout}")
-            if result.stderr:
-                # Split on both newlines and container operations
-                stderr_text = result.stderr
-                for split_term in ['container', '\n']:
-                    stderr_text = stderr_text.replace(split_term, '\n' + split_term)
-                stderr_lines = [line.strip() for line in stderr_text.splitlines() if line.strip()]
-                
-                for line in stderr_lines:
-                    # Check for normal docker operations
-                    if any(normal_msg in line.lower() for normal_msg in 
-                          ['stopping', 'removing', 'removed', 'starting', 'started', 'done']):
-                        logger.info(f"Docker compose: {line}")
-                    else:
-                        logger.error(f"Update executor error: {line}")
-            if result.returncode != 0:
-                logger.error(f"Update failed for {update_file}")
+    config_changes = [path for path in DOCKER_FILES if path in staged]
+    installs = tuple(('install', github_path) for github_path in config_changes)
+    if 'config/docker-compose.yml' in staged:
+        # Once the stack is down it comes back up even if an install failed
+        stopped = (('stop_stack', None),)
+        plan.append(('stop_stack', None, ()))
+        plan += [install + (stopped,) for install in installs]
+        plan.append(('start_stack', None, stopped))
+    elif config_changes:
+        # Reloading is pointless if no new file was installed
+        plan += [install + ((),) for install in installs]
+        plan.append(('reload_prometheus', None, installs))
     
-    # Handle other updates normally
-    for update_file in other_updates:
-        result = subprocess.run(
-            [f"{LOCAL_BASE_DIR}/update-executor.sh", update_file],
-            capture_output=True,
-            text=True
-        )
-        if result.stdout:
-            logger.info(f"Update executor output: {result.stdout}")
-            if result.stderr:
-                # Split on both newlines and container operations
-                stderr_text = result.stderr
-                for split_term in ['container', '\n']:
-                    stderr_text = stderr_text.replace(split_term, '\n' + split_term)
-                stderr_lines = [line.strip() for line in stderr_text.splitlines() if line.strip()]
-                
-                for line in stderr_lines:
-                    # Check for normal docker operations
-                    if any(normal_msg in line.lower() for normal_msg in 
-                          ['stopping', 'removing', 'removed', 'starting', 'started', 'done']):
-                        logger.info(f"Docker compose: {line}")
-                    else:
-                        logger.error(f"Update executor error: {line}")
-        if result.returncode != 0:
-            logger.error(f"Update failed for {update_file}")
-
-def get_remote_updates():
-    """Get list of update files from GitHub"""
+    if 'services/opennds-exporter.py' in staged:
+        plan.append(('install', 'services/opennds-exporter.py', ()))
+        plan.append(('restart_exporter', None, (('install', 'services/opennds-exporter.py'),)))
+    # Updating the checker stops this process, so it always goes last
+    if 'scripts/update/update-checker.py' in staged:
+        plan.append(('run_executor', staged['scripts/update/update-checker.py'], ()))
+    return plan
+
+def replace_executor(tmp_path):
+    """Swap in a new update-executor.sh through the handler"""
+    logger.info("Handling executor update directly...")
+    return run_logged(['python3', f"{LOCAL_BASE_DIR}/update-executor-handler.py", tmp_path], "Executor handler")
+
+def backup_file(local_path):
+    """
+    Save a file that is about to be replaced to the backup store.
+    The store hardlinks it rather than copying, which is safe because the
+    caller replaces the file by rename.
+    """
+    if not os.path.exists(BACKUP_STORE):
+        # Routers set up before the store existed get it with this update
+        logger.warning(f"Backup store not installed yet, replacing {local_path} without a backup")
+        return True
+    return run_logged(['python3', BACKUP_STORE, 'save', '--link', local_path], "Backup store")
+
+def install_config(github_path):
+    """Back up a core file and move its staged version into place"""
+    local_path = CORE_FILES[github_path]
     try:
-        # Using GitHub API to list directory contents
-        api_url = "https://api.github.com/repos/yaswanthsk04/guesthub_v0.1.0/contents/updates"
-        response = requests.get(api_url)
-        
-        # If directory doesn't exist, no updates available
-        if response.status_code == 404:
-            logger.info("No updates directory found in repository")
-            return []
-            
-        response.raise_for_status()
-        
-        updates = []
-        for item in response.json():
-            if item['type'] == 'file' and item['name'].startswith('update'):
-                try:
-                    # Extract number from update name (e.g., 'update123' -> 123)
-                    update_num = int(item['name'].replace('update', ''))
-                    updates.append((update_num, item['name']))
-                except ValueError:
-                    continue
+        if os.path.exists(local_path) and not backup_file(local_path):
+            logger.error(f"Not installing {github_path} without a backup")
+            os.remove(f"{local_path}.new")
+            return False
         
-        # Sort updates by number
-        updates.sort(key=lambda x: x[0])
-        return [name for num, name in updates]
-    except requests.exceptions.RequestException as e:
-        if hasattr(e.response, 'status_code') and e.response.status_code == 404:
-            logger.info("No updates directory found in repository")
-        else:
-            logger.error(f"Error checking for updates: {e}")
-        return []
+        os.replace(f"{local_path}.new", local_path)
+        set_permissions(local_path)
+        logger.info(f"Installed new {github_path}")
+        return True
     except Exception as e:
-        logger.error(f"Unexpected error checking for updates: {e}")
-        return []
+        logger.error(f"Error installing {github_path}: {e}")
+        return False
+
+def stop_stack(_):
+    """Take the docker-compose stack down with the compose file it was started from"""
+    logger.info("Stopping Docker services...")
+    return run_logged(['docker-compose', 'down'], "Docker compose down", cwd=DOCKER_DIR)
+
+def start_stack(_):
+    """Bring the docker-compose stack up from the installed compose file"""
+    logger.info("Starting Docker services...")
+    if not run_logged(['docker-compose', 'up', '-d'], "Docker compose up", cwd=DOCKER_DIR):
+        return False
+    
+    # Verify services are running
+    result = subprocess.run(['docker-compose', 'ps'], cwd=DOCKER_DIR, capture_output=True, text=True,
+                            timeout=COMMAND_TIMEOUT)
+    if 'Up' not in result.stdout:
+        logger.error("Docker services failed to start")
+        return False
+    logger.info("Docker services updated and running successfully")
+    return True
+
+def reload_prometheus(_):
+    """Make Prometheus re-read its config without restarting the stack"""
+    logger.info("Reloading Prometheus configuration...")
+    if run_logged(['docker', 'kill', '--signal', 'HUP', PROMETHEUS_CONTAINER], "Prometheus reload"):
+        return True
+    logger.info("Hot reload failed, restarting the Prometheus container only")
+    return run_logged(['docker-compose', 'restart', 'prometheus'], "Prometheus restart", cwd=DOCKER_DIR)
+
+def restart_exporter(_):
+    """Restart the OpenNDS exporter service so it runs the installed version"""
+    logger.info("Restarting OpenNDS exporter...")
+    if not run_logged([EXPORTER_SERVICE, 'restart'], "Exporter restart"):
+        return False
+    
+    result = subprocess.run([EXPORTER_SERVICE, 'status'], capture_output=True, text=True, timeout=COMMAND_TIMEOUT)
+    if 'running' not in result.stdout:
+        logger.error("OpenNDS exporter failed to start")
+        return False
+    logger.info("OpenNDS exporter updated and running successfully")
+    return True
+
+def run_executor(tmp_path):
+    """Hand a staged file to update-executor.sh, which restarts its service"""
+    return run_logged([f"{LOCAL_BASE_DIR}/update-executor.sh", tmp_path], "Update executor")
+
+# Functions that carry out each planned action
+PLAN_ACTIONS = {
+    'replace_executor': replace_executor,
+    'install': install_config,
+    'stop_stack': stop_stack,
+    'start_stack': start_stack,
+    'reload_prometheus': reload_prometheus,
+    'restart_exporter': restart_exporter,
+    'run_executor': run_executor
+}
+
+def execute_plan(plan):
+    """
+    Run each planned step once, in order, skipping steps none of whose
+    requirements succeeded. A step that raises counts as failed.
+    """
+    succeeded = set()
+    for action, argument, requires in plan:
+        step = action + (f" for {argument}" if argument else "")
+        if requires and succeeded.isdisjoint(requires):
+            logger.warning(f"Skipping update step {step}, the steps it depends on failed")
+            continue
+        try:
+            ok = PLAN_ACTIONS[action](argument)
+        except Exception as e:
+            # e.g. a status check timing out; the remaining steps still run
+            logger.error(f"Update step {step} failed: {e}")
+            continue
+        if ok:
+            succeeded.add((action, argument))
+        else:
+            logger.error(f"Update step {step} failed")
+
+def check_core_files(manifest):
+    """
+    Check and update core configuration files.
+    Only files whose SHA in the manifest differs from the local content are
+    downloaded, and the changes are applied with as few restarts as possible.
+    """
+    # Skip if we're in the middle of an update
+    if os.path.exists(f"{LOCAL_BASE_DIR}/update-checker.py.new"):
+        logger.info("Update in progress, skipping check")
+        return
+    
+    # First pass: Check all files and stage updates concurrently, so a cycle
+    # costs about one round trip instead of one per file
+    holds = load_holds()
+    with ThreadPoolExecutor(max_workers=FETCH_CONCURRENCY) as pool:
+        staged = dict(zip(UPDATE_ORDER, pool.map(lambda path: stage_core_file(path, manifest, holds),
+                                                 UPDATE_ORDER)))
+    staged = {path: tmp_path for path, tmp_path in staged.items() if tmp_path is not None}
+    if not staged:
+        return
+    
+    # Second pass: Apply everything that changed with one plan
+    plan = plan_core_updates(staged)
+    logger.info("Update plan: " + ", ".join(action + (f" {argument}" if argument else "")
+                                            for action, argument, _ in plan))
+    execute_plan(plan)
+
+def read_last_update():
+    """Number of the last update the executor ran, from state/last_update"""
+    try:
+        with open(LAST_UPDATE_FILE, 'r') as f:
+            return int(f.read().strip() or 0)
+    except FileNotFoundError:
+        return 0
+    except ValueError as e:
+        logger.error(f"Invalid last update number in {LAST_UPDATE_FILE}: {e}")
+        return 0
+
+def parse_update_number(path):
+    """Update number of a repository path like 'updates/update123', or None"""
+    if not path.startswith(UPDATE_PREFIX):
+        return None
+    number = path[len(UPDATE_PREFIX):]
+    return int(number) if number.isdigit() else None
+
+class UpdateQueue:
+    """
+    Numbered update scripts newer than the last executed one, kept sorted by
+    number. Discovery only rescans the manifest when the updates/ tree changes,
+    so a cycle with no new updates costs nothing however many updates exist.
+    """
+    
+    def __init__(self):
+        self.pending = []  # Sorted (number, repository path) not yet downloaded
+        self.highest_seen = 0
+        self.tree_sha = None
+    
+    def discover(self, manifest, tree_sha):
+        """Queue any updates in the manifest newer than anything seen before"""
+        if tree_sha is not None and tree_sha == self.tree_sha:
+            return
+        floor = max(self.highest_seen, read_last_update())
+        for path in manifest:
+            number = parse_update_number(path)
+            if number is not None and number > floor:
+                bisect.insort(self.pending, (number, path))
+                self.highest_seen = max(self.highest_seen, number)
+        self.tree_sha = tree_sha
+    
+    def __iter__(self):
+        return iter(list(self.pending))
+    
+    def remove(self, item):
+        """Drop an update once it has been handed to the executor"""
+        index = bisect.bisect_left(self.pending, item)
+        if index < len(self.pending) and self.pending[index] == item:
+            del self.pending[index]
+
+update_queue = UpdateQueue()
 
-def check_update_scripts():
-    """Check and download update scripts"""
+def check_update_scripts(manifest, updates_tree):
+    """Download new update scripts in order and hand them to the executor"""
     try:
-        remote_updates = get_remote_updates()
-        for update in remote_updates:
-            local_path = f"{LOCAL_BASE_DIR}/updates/{update}"
-            if not os.path.exists(local_path):
-                logger.info(f"Found new update: {update}")
-                if download_file(f"updates/{update}", local_path):
-                    subprocess.run([f"{LOCAL_BASE_DIR}/update-executor.sh", local_path])
+        update_queue.discover(manifest, updates_tree)
+        downloaded = False
+        for number, github_path in update_queue:
+            logger.info(f"Found new update: {github_path}")
+            local_path = f"{LOCAL_BASE_DIR}/{github_path}"
+            if not download_file(github_path, local_path, manifest.get(github_path)):
+                # Later updates must not run before this one, retry next cycle
+                break
+            update_queue.remove((number, github_path))
+            downloaded = True
+        
+        # The executor runs every downloaded update newer than state/last_update
+        if downloaded:
+            run_logged([f"{LOCAL_BASE_DIR}/update-executor.sh"], "Update executor")
     except Exception as e:
         logger.error(f"Error checking update scripts: {e}")
 
+class PollScheduler:
+    """
+    Decides how long to wait before the next check. Failures back off
+    exponentially, GitHub's rate limit headers stretch the interval so the
+    requests actually being spent last until the limit resets, and every
+    wait is jittered last so stretched waits are spread across the fleet too.
+    """
+    
+    def __init__(self):
+        self.failures = 0
+        self.remaining = None  # X-RateLimit-Remaining from the latest API response
+        self.reset_at = 0  # X-RateLimit-Reset, epoch seconds
+        self.spent = 0  # Drop in Remaining since the last wait, by us or routers sharing our IP
+        self.lock = threading.Lock()  # Responses arrive on fetch worker threads
+    
+    def observe(self, response, *args, **kwargs):
+        """requests response hook: remember the API rate limit headers"""
+        headers = response.headers
+        with self.lock:
+            if 'X-RateLimit-Remaining' in headers and 'X-RateLimit-Reset' in headers:
+                remaining = int(headers['X-RateLimit-Remaining'])
+                reset_at = int(headers['X-RateLimit-Reset'])
+                # 304s leave Remaining unchanged; a new window resets it
+                if self.remaining is not None and reset_at == self.reset_at:
+                    self.spent += max(0, self.remaining - remaining)
+                self.remaining = remaining
+                self.reset_at = reset_at
+            retry_after = headers.get('Retry-After', '')
+            if response.status_code in (403, 429) and retry_after.isdigit():
+                # Secondary rate limits only say how long to stay away
+                self.remaining = 0
+                self.reset_at = max(self.reset_at, time.time() + int(retry_after))
+    
+    def record_result(self, success):
+        self.failures = 0 if success else self.failures + 1
+    
+    def rate_limit_wait(self):
+        """Seconds until the rate limit resets if no API requests are left, else 0"""
+        with self.lock:
+            if self.remaining is None or self.remaining > 0:
+                return 0
+            return max(0, self.reset_at - time.time())
+    
+    def next_delay(self):
+        """Seconds to wait before the next scheduled check"""
+        if self.failures:
+            backoff = min(MAX_BACKOFF, CHECK_INTERVAL * 2 ** min(self.failures, 10))
+            delay = random.uniform(CHECK_INTERVAL, backoff)
+        else:
+            delay = CHECK_INTERVAL
+        
+        with self.lock:
+            spent, self.spent = self.spent, 0
+            if self.remaining is not None:
+                until_reset = max(0, self.reset_at - time.time())
+                budget = self.remaining - RATE_LIMIT_RESERVE
+                if budget <= 0:
+                    # Spread the fleet's first requests after the reset
+                    return max(delay, until_reset + random.uniform(0, CHECK_INTERVAL))
+                # Cycles that cost this many requests must fit in what's left;
+                # free revalidations (spent == 0) don't stretch anything
+                delay = max(delay, until_reset * spent / budget)
+        return delay * random.uniform(1 - POLL_JITTER, 1 + POLL_JITTER)
+
+scheduler = PollScheduler()
+session.hooks['response'].append(scheduler.observe)
+
+# Set by the trigger endpoint to start a check without waiting for the schedule
+check_requested = threading.Event()
+
+class TriggerHandler(BaseHTTPRequestHandler):
+    """POST /check starts an update check straight away"""
+    
+    def do_POST(self):
+        if self.path != '/check':
+            self.send_error(404)
+            return
+        check_requested.set()
+        self.send_response(202)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+    
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'local'
+    
+    def log_message(self, format, *args):
+        logger.info(f"Trigger from {self.address_string()}: {format % args}")
+
+class UnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+def start_trigger_server(port=None, socket_path=None):
+    """Serve the trigger endpoint on a local port or Unix socket in the background"""
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixHTTPServer(socket_path, TriggerHandler)
+        logger.info(f"Trigger endpoint listening on {socket_path}")
+    else:
+        # Only local clients (an operator or a webhook relay) may trigger checks
+        server = ThreadingHTTPServer(('127.0.0.1', port), TriggerHandler)
+        logger.info(f"Trigger endpoint listening on 127.0.0.1:{port}")
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
 def check_for_updates():
     """Check both core files and update scripts"""
     logger.info("Starting update check cycle...")
     ensure_updates_dir()
     
+    # One request tells us the content hash of every tracked file
+    manifest, updates_tree = fetch_manifest()
+    if manifest is None:
+        logger.error("Skipping update check, repository manifest unavailable")
+        return False
+    
     # Check core files
     logger.info("Checking core files for updates...")
-    check_core_files()
+    check_core_files(manifest)
     
     # Check update scripts
     logger.info("Checking for update scripts...")
-    check_update_scripts()
+    check_update_scripts(manifest, updates_tree)
     
     logger.info("Update check cycle completed")
+    return True
 
 def main():
+    parser = argparse.ArgumentParser(description="Check GitHub for monitoring stack updates")
+    parser.add_argument('--trigger-port', type=int,
+                        help="serve POST /check on this localhost port to start a check immediately")
+    parser.add_argument('--trigger-socket', help="serve POST /check on this Unix socket instead")
+    args = parser.parse_args()
+    signal.signal(signal.SIGTERM, flush_logs_and_exit)
+    
     logger.info("********************************")
     logger.info("Update checker starting - Version 0.1.0 - TEST UPDATE")
     logger.info("********************************")
@@ -302,15 +914,28 @@ def main():
             except Exception as e:
                 logger.error(f"Failed to clean up {new_file}: {e}")
     
+    if args.trigger_port or args.trigger_socket:
+        start_trigger_server(args.trigger_port, args.trigger_socket)
+    
     while True:
         try:
-            check_for_updates()
-            next_check = datetime.now() + timedelta(seconds=CHECK_INTERVAL)
-            logger.info(f"Next check scheduled for: {next_check.strftime('%Y-%m-%d %H:%M:%S')}")
-            time.sleep(CHECK_INTERVAL)
+            success = check_for_updates()
         except Exception as e:
             logger.error(f"Error in main loop: {e}")
-            time.sleep(60)  # Wait a minute before retrying on error
+            success = False
+        scheduler.record_result(success)
+        
+        delay = scheduler.next_delay()
+        next_check = datetime.now() + timedelta(seconds=delay)
+        logger.info(f"Next check scheduled for: {next_check.strftime('%Y-%m-%d %H:%M:%S')}")
+        if check_requested.wait(delay):
+            check_requested.clear()
+            wait = scheduler.rate_limit_wait()
+            if wait:
+                logger.warning(f"Triggered check deferred {wait:.0f}s until the GitHub rate limit resets")
+                time.sleep(wait)
+            else:
+                logger.info("Update check triggered")
 
 if __name__ == "__main__":
     main()
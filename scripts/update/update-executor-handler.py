@@ -3,7 +3,7 @@ import os
 import sys
 import shutil
 import logging
-from datetime import datetime
+import subprocess
 
 # Setup logging
 logging.basicConfig(
@@ -20,17 +20,16 @@ def update_executor(new_file):
     """Handle update-executor.sh update"""
     base_dir = "/usr/local/monitoring"
     executor_path = f"{base_dir}/update-system/executor.sh"
-    backup_dir = f"{base_dir}/backups/{datetime.now().strftime('%Y%m%d')}"
+    backup_store = f"{base_dir}/update-system/backup-store.py"
     
     try:
-        # Create backup directory
-        os.makedirs(backup_dir, exist_ok=True)
-        
-        # Move old executor to backup with timestamp
-        if os.path.exists(executor_path):
-            backup_name = f"update-executor.sh.{datetime.now().strftime('%H%M%S')}.bak"
-            shutil.move(executor_path, f"{backup_dir}/{backup_name}")
-            logging.info(f"Moved old executor to {backup_dir}/{backup_name}")
+        # Back up the old executor; it is replaced by rename below, so the
+        # store can hardlink it instead of copying
+        if os.path.exists(executor_path) and not os.path.exists(backup_store):
+            logging.warning("Backup store not installed yet, replacing executor without a backup")
+        elif os.path.exists(executor_path):
+            subprocess.run(['python3', backup_store, 'save', '--link', executor_path], check=True)
+            logging.info("Backed up old executor")
         
         # Move new file into place
         shutil.move(new_file, executor_path)
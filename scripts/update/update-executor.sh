@@ -39,10 +39,16 @@ log_error() {
 # Function to create backup with timestamp
 create_backup() {
     local file="$1"
-    local backup_dir="/usr/local/monitoring/backups/$(date +%Y%m%d)"
-    mkdir -p "$backup_dir"
-    cp "$file" "$backup_dir/$(basename "$file").$(date +%H%M%S).bak"
-    log_message "INFO" "Backup created in $backup_dir"
+    if [ ! -f /usr/local/monitoring/update-system/backup-store.py ]; then
+        log_message "INFO" "Backup store not installed yet, replacing $file without a backup"
+        return
+    fi
+    # Files here are overwritten in place with cp, so the store must copy them
+    if python3 /usr/local/monitoring/update-system/backup-store.py save "$file"; then
+        log_message "INFO" "Backup created for $file"
+    else
+        log_error "Backup failed for $file"
+    fi
 }
 
 # Function to handle docker-compose.yml updates
@@ -290,10 +296,11 @@ execute_update() {
                     fi
                 fi
                 ;;
-            "opennds-exporter.py")
+            # Staged files are named after their local path, e.g. checker.py.new
+            "opennds-exporter.py"|"opennds.py")
                 handle_opennds_exporter "$update_file"
                 ;;
-            "update-checker.py")
+            "update-checker.py"|"checker.py")
                 handle_update_checker "$update_file"
                 ;;
             *)
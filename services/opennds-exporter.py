@@ -1,141 +1,1002 @@
 #!/usr/bin/env python3
+import os
+import re
+import sys
+import gzip
+import json
+import mmap
 import time
+import heapq
+import signal
+import socket
+import struct
+import hashlib
+import cProfile
+import tracemalloc
+import argparse
+import threading
 import subprocess
-from datetime import datetime
-from prometheus_client import start_http_server, Gauge, Info, REGISTRY
+from array import array
+from operator import attrgetter
+from collections import namedtuple
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs
+from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
+from prometheus_client import Counter, Histogram, REGISTRY
+from prometheus_client.exposition import choose_encoder
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
 
-# Define Prometheus metrics
-# Info metric combines all client data into one metric for better table display
-CLIENT_METRICS = Info('opennds_client_metrics', 'Combined client metrics', ['mac', 'ip'])
+# Background refresh timing (seconds). The interval starts at REFRESH_INTERVAL and
+# adapts between the min and max to collection cost and client churn.
+REFRESH_INTERVAL = 15
+MIN_REFRESH_INTERVAL = 5
+MAX_REFRESH_INTERVAL = 30
+# Keep collection under 1/REFRESH_COST_FACTOR of wall time (5%)
+REFRESH_COST_FACTOR = 20
+# How strongly client churn (joins + leaves per client) shortens the interval
+CHURN_WEIGHT = 4
+# Stop refreshing when nothing has scraped for this long
+IDLE_TIMEOUT = 120
+# Hard limit on a single ndsctl call; opennds can hang while reloading
+NDSCTL_TIMEOUT = 10
 
-# Router-wide metrics remain as Gauges since they're single values
-ROUTER_DOWNLOAD = Gauge('opennds_router_download_bytes_total', 'Total router download')
-ROUTER_UPLOAD = Gauge('opennds_router_upload_bytes_total', 'Total router upload')
+# Samples kept per client for throughput rates, and how many top talkers to export
+RATE_HISTORY = 8
+TOP_TALKERS = 5
+
+# Client states reported by ndsctl, exported as an enum-style gauge
+CLIENT_STATES = ('Preauthenticated', 'Authenticated', 'Unknown')
+
+# Router-wide values from one refresh; per-client data lives in the ClientTable
+Snapshot = namedtuple('Snapshot', ['timestamp', 'router_download', 'router_upload'])
+
+# One rendered /metrics body, kept plain and gzip-compressed
+CachedBody = namedtuple('CachedBody', ['rendered_at', 'body', 'gzipped', 'etag'])
+# Compression level for cached bodies; they're compressed once per refresh, not per scrape
+GZIP_LEVEL = 6
+# Accept headers whose formats are rendered after every refresh: the text format
+# curl and older Prometheus get, and OpenMetrics, which Prometheus asks for
+PRERENDERED_FORMATS = [None, 'application/openmetrics-text;version=1.0.0']
+
+# Where SIGUSR1 profiles and SIGUSR2 allocation reports are written
+PROFILE_DIR = '/tmp'
+
+# On-disk sample buffer that lets /backfill fill gaps while Prometheus is down.
+# /tmp is RAM on OpenWrt, so the buffer survives exporter and Prometheus
+# restarts without wearing out flash.
+RING_FILE = '/tmp/opennds-exporter.ring'
+RING_SIZE = 4 * 1024 * 1024  # About 120,000 samples: 5 hours of 100 clients at 15 s
+# /backfill reads the ring and writes its response this many records at a time,
+# so serving a full ring never holds more than a small index in memory
+BACKFILL_CHUNK_RECORDS = 4096
+
+# Self-instrumentation: what the exporter itself costs on the router
+NDSCTL_DURATION = Histogram('opennds_exporter_ndsctl_duration_seconds',
+                            'Wall time of ndsctl calls, from start to exit')
+PARSE_DURATION = Histogram('opennds_exporter_parse_duration_seconds',
+                           'CPU time spent parsing ndsctl output')
+UPDATE_DURATION = Histogram('opennds_exporter_update_duration_seconds',
+                            'Time spent turning parsed data into a snapshot')
+PARSE_ERRORS = Counter('opennds_exporter_parse_errors_total',
+                       'Values in ndsctl output that could not be parsed', ['reason'])
+SOURCE_ERRORS = Counter('opennds_exporter_source_errors_total',
+                        'Failed reads from the data source', ['source', 'reason'])
+
+# Multipliers for the byte units ndsctl prints. openNDS spells byte
+# units 'kByte', 'MByte', ...; the short forms cover older releases.
+BYTE_UNITS = {
+    'B': 1, 'Byte': 1, 'Bytes': 1,
+    'kB': 1024, 'KB': 1024, 'KiB': 1024, 'kByte': 1024, 'KByte': 1024,
+    'MB': 1024 ** 2, 'MiB': 1024 ** 2, 'MByte': 1024 ** 2,
+    'GB': 1024 ** 3, 'GiB': 1024 ** 3, 'GByte': 1024 ** 3,
+    'TB': 1024 ** 4, 'TiB': 1024 ** 4, 'TByte': 1024 ** 4
+}
+
+# Number followed by an optional unit, e.g. '1.5 kB' or '12 kByte'
+VALUE_PATTERN = re.compile(r'\s*([0-9]*\.?[0-9]+)\s*([A-Za-z/]*)')
+
+def parse_value(value, units, default_unit):
+    """
+    Convert a number with a unit suffix using the given unit table.
+    Anything after a ';' (such as the session average) is ignored.
+    Returns 0 if the value cannot be parsed.
+    """
+    match = VALUE_PATTERN.match(value.split(';', 1)[0])
+    if not match:
+        PARSE_ERRORS.labels(reason='format').inc()
+        return 0
+    multiplier = units.get(match.group(2) or default_unit)
+    if multiplier is None:
+        PARSE_ERRORS.labels(reason='unit').inc()
+        return 0
+    return float(match.group(1)) * multiplier
 
 def parse_bytes(value):
     """
     Convert human-readable byte strings into numeric values.
-    Examples: '1.5 kB' -> 1536, '500 B' -> 500
+    Examples: '1.5 kB' -> 1536, '500 B' -> 500, '2 MByte' -> 2097152
+    """
+    return parse_value(value, BYTE_UNITS, 'B')
+
+def parse_address(client, value):
+    """Split 'IP: <ip> MAC: <mac>' into separate fields"""
+    ip, _, mac = value.partition('MAC:')
+    client['ip'] = ip.strip()
+    client['mac'] = mac.strip()
+
+# Keys in the router-wide section of ndsctl status: key -> [(field, parser), ...]
+# Only fields something reads are parsed; rates come from the ClientTable's
+# sample history, not from ndsctl's session averages.
+ROUTER_FIELDS = {
+    'Total download': [('total_download', parse_bytes)],
+    'Total upload': [('total_upload', parse_bytes)]
+}
+
+# Keys in each client section: key -> [(field, parser), ...]
+CLIENT_FIELDS = {
+    'Client Type': [('type', sys.intern)],
+    'State': [('state', sys.intern)],
+    'Download this session': [('download', parse_bytes)],
+    'Upload this session': [('upload', parse_bytes)]
+}
+
+def parse_nds_status(lines):
+    """
+    Parse ndsctl status output from any iterable of lines.
+    Lines are consumed one at a time, so output can be parsed as it streams in.
+    Returns tuple of (router_stats, client_data_list) with numeric byte counts.
     """
+    total_stats = {}  # Router-wide statistics
+    clients_data = [] # List to hold per-client data
+    current_client = None
+    router_fields = ROUTER_FIELDS
+    client_fields = CLIENT_FIELDS
+
+    for line in lines:
+        key, sep, value = line.strip().partition(':')
+        if not sep:
+            # 'Client <n>' headers are the only lines without a colon we care about
+            if key.startswith('Client '):
+                current_client = {}
+                clients_data.append(current_client)
+            continue
+
+        value = value.strip()
+        if current_client is None:
+            fields = router_fields.get(key)
+            target = total_stats
+        elif key == 'IP':
+            parse_address(current_client, value)
+            continue
+        else:
+            fields = client_fields.get(key)
+            target = current_client
+
+        if fields:
+            for field, parser in fields:
+                target[field] = parser(value)
+
+    return total_stats, clients_data
+
+# ndsctl json reports session byte counts as plain numbers in kB
+JSON_CLIENT_FIELDS = {
+    'client_type': ('type', sys.intern),
+    'mac': ('mac', str),
+    'ip': ('ip', str),
+    'state': ('state', sys.intern),
+    'download_this_session': ('download', lambda value: float(value) * BYTE_UNITS['kB']),
+    'upload_this_session': ('upload', lambda value: float(value) * BYTE_UNITS['kB'])
+}
+JSON_ROUTER_FIELDS = {
+    'total_download': ('total_download', lambda value: float(value) * BYTE_UNITS['kB']),
+    'total_upload': ('total_upload', lambda value: float(value) * BYTE_UNITS['kB'])
+}
+
+def parse_nds_json(data):
+    """
+    Convert decoded ndsctl json output into (router_stats, client_data_list).
+    Clients may be given as an object keyed by MAC or as a list.
+    Router totals are only included when ndsctl reports them.
+    """
+    total_stats = {}
+    for key, (field, parser) in JSON_ROUTER_FIELDS.items():
+        if key in data:
+            total_stats[field] = parser(data[key])
+
+    clients = data.get('clients') or {}
+    if isinstance(clients, dict):
+        clients = clients.values()
+
+    clients_data = []
+    for entry in clients:
+        client = {}
+        for key, (field, parser) in JSON_CLIENT_FIELDS.items():
+            if key in entry:
+                client[field] = parser(entry[key])
+        clients_data.append(client)
+
+    return total_stats, clients_data
+
+def timed_parse(parse, stream):
+    """Run parse(stream), recording the CPU time it used in PARSE_DURATION"""
+    # Thread CPU time excludes time spent blocked waiting for ndsctl to write
+    start = time.thread_time()
     try:
-        if 'kB' in value:
-            # Convert kilobytes to bytes
-            return float(value.split()[0]) * 1024
-        return float(value.split()[0])
-    except:
-        return 0
+        return parse(stream)
+    finally:
+        PARSE_DURATION.observe(time.thread_time() - start)
+
+def stream_command(args, parse, timeout, text=True):
+    """
+    Run a command and hand its stdout stream to parse().
+    The process is killed if it runs longer than timeout seconds,
+    in which case subprocess.TimeoutExpired is raised.
+    """
+    start = time.perf_counter()
+    expired = threading.Event()
+
+    def kill():
+        expired.set()
+        process.kill()
+
+    with subprocess.Popen(args, stdout=subprocess.PIPE, text=text) as process:
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+        try:
+            result = timed_parse(parse, process.stdout)
+            process.wait()
+        except Exception:
+            # A killed process usually surfaces as truncated output; report the timeout instead
+            if expired.is_set():
+                raise subprocess.TimeoutExpired(args, timeout)
+            raise
+        finally:
+            timer.cancel()
+            NDSCTL_DURATION.observe(time.perf_counter() - start)
 
-def get_nds_data():
+    if expired.is_set():
+        raise subprocess.TimeoutExpired(args, timeout)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, args)
+    return result
+
+class TextSource:
+    """Reads the human-readable 'ndsctl status' output, parsing it as it streams"""
+
+    name = 'text'
+
+    def __init__(self, timeout=NDSCTL_TIMEOUT):
+        self.timeout = timeout
+
+    def read(self):
+        return stream_command(['ndsctl', 'status'], parse_nds_status, self.timeout)
+
+class JSONSource:
+    """Reads structured 'ndsctl json' output, avoiding text parsing entirely"""
+
+    name = 'json'
+
+    def __init__(self, timeout=NDSCTL_TIMEOUT):
+        self.timeout = timeout
+
+    def read(self):
+        return stream_command(['ndsctl', 'json'], lambda stream: parse_nds_json(json.load(stream)),
+                              self.timeout, text=False)
+
+class FileSource:
     """
-    Retrieve and parse data from ndsctl status command.
-    Returns tuple of (router_stats, client_data_list)
+    Replays captured ndsctl output so the exporter can run without OpenNDS.
+    The path may be a single capture or a directory of captures, which are
+    replayed in name order, one per read, wrapping around at the end.
+    Files ending in .json are decoded as 'ndsctl json', anything else as 'ndsctl status'.
+    """
+
+    name = 'file'
+
+    def __init__(self, path):
+        if os.path.isdir(path):
+            self.paths = sorted(os.path.join(path, name) for name in os.listdir(path)
+                                if os.path.isfile(os.path.join(path, name)))
+        else:
+            self.paths = [path]
+        if not self.paths:
+            raise ValueError(f"No captures found in {path}")
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def read(self):
+        with self._lock:
+            path = self.paths[self._next]
+            self._next = (self._next + 1) % len(self.paths)
+
+        with open(path, 'r') as f:
+            if path.endswith('.json'):
+                return timed_parse(lambda stream: parse_nds_json(json.load(stream)), f)
+            return timed_parse(parse_nds_status, f)
+
+# Backends selectable with --source
+SOURCES = {
+    'text': TextSource,
+    'json': JSONSource,
+    'file': FileSource
+}
+
+def get_nds_data(source):
+    """
+    Retrieve and parse data from the given source.
+    Returns tuple of (router_stats, client_data_list), or None if the read failed
     """
     try:
-        # Run ndsctl status command and get output
-        nds_output = subprocess.check_output(['ndsctl', 'status']).decode('utf-8')
-        lines = nds_output.split('\n')
-        
-        # Initialize data structures
-        total_stats = {}  # Router-wide statistics
-        clients_data = [] # List to hold per-client data
-        current_client = None
-        
-        # Parse each line of the output
-        for line in lines:
-            line = line.strip()
-            
-            # Handle router-wide statistics
-            if 'Total download:' in line:
-                total_stats['total_download'] = line.split(':', 1)[1].split(';')[0].strip()
-            elif 'Total upload:' in line:
-                total_stats['total_upload'] = line.split(':', 1)[1].split(';')[0].strip()
-            
-            # Handle per-client data
-            if line.startswith('Client ') and 'Type:' not in line:
-                # New client section started
-                if current_client:
-                    clients_data.append(current_client)
-                current_client = {}
-            elif current_client is not None and ':' in line:
-                # Parse client details
-                key, value = [x.strip() for x in line.split(':', 1)]
-                if key == 'Client Type':
-                    current_client['type'] = value
-                elif 'MAC:' in value:
-                    # Split IP and MAC address
-                    current_client['ip'] = value.split('MAC:')[0].strip()
-                    current_client['mac'] = value.split('MAC:')[1].strip()
-                elif key == 'State':
-                    current_client['state'] = value
-                elif key == 'Download this session':
-                    current_client['download'] = value
-                elif key == 'Upload this session':
-                    current_client['upload'] = value
-        
-        # Add last client if exists
-        if current_client:
-            clients_data.append(current_client)
-                
-        return total_stats, clients_data
+        return source.read()
+    except subprocess.TimeoutExpired as e:
+        SOURCE_ERRORS.labels(source=source.name, reason='timeout').inc()
+        print(f"Error getting NDS data from {source.name} source: {e}")
     except Exception as e:
-        print(f"Error getting NDS data: {e}")
-        return {}, []
+        SOURCE_ERRORS.labels(source=source.name, reason='error').inc()
+        print(f"Error getting NDS data from {source.name} source: {e}")
+    return None
 
-def update_metrics():
+class ClientRecord:
     """
-    Update all Prometheus metrics with fresh data.
-    Clears old metrics and sets new values for all connected clients.
+    One connected client, updated in place on every refresh.
+    Throughput samples live in a flat array used as a ring buffer of
+    (timestamp, download, upload) triples, so adding a sample allocates nothing.
     """
-    # Get fresh data from ndsctl
-    total_stats, clients_data = get_nds_data()
-    
-    # Clear existing client metrics by unregistering and re-registering
-    try:
-        REGISTRY.unregister(CLIENT_METRICS)
-    except KeyError:
-        pass  # Ignore if metrics weren't registered yet
-    
-    # Re-register the metrics collector
-    REGISTRY.register(CLIENT_METRICS)
-    
-    # Update router totals
-    router_download = parse_bytes(total_stats.get('total_download', '0'))
-    router_upload = parse_bytes(total_stats.get('total_upload', '0'))
-    ROUTER_DOWNLOAD.set(router_download)
-    ROUTER_UPLOAD.set(router_upload)
-    
-    # Update metrics for currently connected clients
-    active_clients = set()  # Track currently active clients
-    for client in clients_data:
-        if client.get('mac') and client.get('ip'):
-            mac = client['mac']
-            ip = client['ip']
-            active_clients.add(f"{mac}_{ip}")
-            
-            # Export all client metrics as a single info metric
-            # This makes it easier to create tables in Grafana
-            CLIENT_METRICS.labels(mac=mac, ip=ip).info({
-                'download_bytes': str(parse_bytes(client['download'].split(';')[0])),
-                'upload_bytes': str(parse_bytes(client['upload'].split(';')[0])),
-                'state': client.get('state', 'Unknown'),
-                'type': client.get('type', 'unknown'),
-                'client_id': f"{mac}_{ip}",
-                'last_seen': datetime.now().isoformat()
-            })
+
+    __slots__ = ('mac', 'ip', 'state', 'type', 'download', 'upload', 'last_seen',
+                 'samples', 'sample_head', 'sample_count',
+                 'download_rate', 'upload_rate', 'peak_download_rate', 'peak_upload_rate')
+
+    def __init__(self, mac, history):
+        self.mac = mac
+        self.ip = None
+        self.state = 'Unknown'
+        self.type = 'unknown'
+        self.download = 0
+        self.upload = 0
+        self.last_seen = 0
+        self.samples = array('d', bytes(8 * 3 * history))
+        self.sample_head = 0
+        self.sample_count = 0
+        self.download_rate = 0
+        self.upload_rate = 0
+        self.peak_download_rate = 0
+        self.peak_upload_rate = 0
+
+    def add_sample(self, timestamp, download, upload):
+        """Record new session counters and recompute current and peak rates"""
+        # Session counters restart when a client re-authenticates
+        if self.sample_count and (download < self.download or upload < self.upload):
+            self.sample_count = 0
+        self.download = download
+        self.upload = upload
+
+        samples = self.samples
+        history = len(samples) // 3
+        offset = self.sample_head * 3
+        samples[offset] = timestamp
+        samples[offset + 1] = download
+        samples[offset + 2] = upload
+        self.sample_head = (self.sample_head + 1) % history
+        self.sample_count = min(self.sample_count + 1, history)
+
+        download_rate = upload_rate = peak_download = peak_upload = 0
+        index = (self.sample_head - self.sample_count) % history
+        previous = None
+        for _ in range(self.sample_count):
+            offset = index * 3
+            if previous is not None and samples[offset] > samples[previous]:
+                elapsed = samples[offset] - samples[previous]
+                download_rate = (samples[offset + 1] - samples[previous + 1]) / elapsed
+                upload_rate = (samples[offset + 2] - samples[previous + 2]) / elapsed
+                peak_download = max(peak_download, download_rate)
+                peak_upload = max(peak_upload, upload_rate)
+            previous = offset
+            index = (index + 1) % history
+
+        self.download_rate = download_rate
+        self.upload_rate = upload_rate
+        self.peak_download_rate = peak_download
+        self.peak_upload_rate = peak_upload
+
+class ClientTable:
+    """
+    Persistent table of connected clients keyed by MAC.
+    Records are updated in place rather than rebuilt each refresh, MAC and IP
+    strings are interned once per client (state and type are interned by the
+    parsers), and departed clients are evicted, so memory is bounded by the
+    number of connected clients.
+
+    Measured with scripts/benchmark/client-table-benchmark.py (CPython 3.11,
+    64-bit, RATE_HISTORY=8), a record costs about 0.5 KiB including its
+    sample buffer: roughly 0.45 MiB at 1,000 clients and 5.4 MiB at 10,000.
+    Updating an existing client allocates only its new float values, about
+    50 bytes per client per refresh, but the parse feeding the update still
+    builds a dict and value strings for every client: a whole refresh peaks
+    at about 0.5 KiB per client (0.5 MiB at 1,000 clients, 4.8 MiB at
+    10,000), all of it freed once the table is updated. The parsers return
+    plain data rather than updating records so that a failed or timed-out
+    read leaves the table untouched.
+
+    Readers must hold lock while iterating records.
+    """
+
+    def __init__(self, history=RATE_HISTORY):
+        self.history = history
+        self.records = {}
+        self.lock = threading.Lock()
+
+    def update(self, clients_data, timestamp):
+        """
+        Apply one refresh of parsed client data.
+        Clients without both a MAC and an IP are skipped.
+        Returns the fraction of clients that joined or left.
+        """
+        records = self.records
+        joined = 0
+        for client in clients_data:
+            mac = client.get('mac')
+            ip = client.get('ip')
+            if not mac or not ip:
+                continue
+
+            record = records.get(mac)
+            if record is None:
+                record = ClientRecord(sys.intern(mac), self.history)
+                records[record.mac] = record
+                joined += 1
+            if record.ip != ip:
+                record.ip = sys.intern(ip)
+            record.state = client.get('state', 'Unknown')
+            record.type = client.get('type', 'unknown')
+            record.last_seen = timestamp
+            record.add_sample(timestamp, client.get('download', 0), client.get('upload', 0))
+
+        # Evict clients this refresh no longer reports
+        departed = [mac for mac, record in records.items() if record.last_seen != timestamp]
+        for mac in departed:
+            del records[mac]
+
+        return (joined + len(departed)) / max(1, len(records) + len(departed))
+
+class SampleRing:
+    """
+    Size-capped ring of timestamped byte counters in a memory-mapped file.
+    Each refresh appends one fixed-size record per client (MAC, IPv4 address,
+    session download and upload) plus one for the router totals, overwriting
+    the oldest records once the file is full. Records are written straight
+    into the shared mapping, so they survive an exporter restart.
+    """
+
+    MAGIC = b'NDSR'
+    HEADER = struct.Struct('<4sIQQ')  # magic, record size, next slot, records held
+    RECORD = struct.Struct('<d6s4sdd')  # timestamp, MAC, IPv4, download, upload
+    ROUTER_KEY = (bytes(6), bytes(4))  # All-zero MAC and IP mark router totals
+
+    def __init__(self, path, size=RING_SIZE):
+        self.capacity = (size - self.HEADER.size) // self.RECORD.size
+        if self.capacity < 1:
+            raise ValueError(f"ring size {size} is too small")
+        size = self.HEADER.size + self.capacity * self.RECORD.size
+        self.lock = threading.Lock()
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != size:
+                os.ftruncate(fd, 0)  # Zero-filled, so the header check below resets it
+                os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+        magic, record_size, self.head, self.count = self.HEADER.unpack_from(self.map)
+        if magic != self.MAGIC or record_size != self.RECORD.size or self.head >= self.capacity:
+            self.head = self.count = 0
+            self._write_header()
+
+    def _write_header(self):
+        self.HEADER.pack_into(self.map, 0, self.MAGIC, self.RECORD.size, self.head, self.count)
+
+    def _offset(self, slot):
+        return self.HEADER.size + slot * self.RECORD.size
+
+    def append(self, timestamp, records, router_download=None, router_upload=None):
+        """Add one refresh worth of samples from ClientRecords and the router totals"""
+        rows = []
+        for record in records:
+            try:
+                key = (bytes.fromhex(record.mac.replace(':', '')), socket.inet_aton(record.ip))
+            except (ValueError, OSError):
+                continue  # Not a MAC/IPv4 pair the record format can hold
+            rows.append((timestamp, *key, record.download, record.upload))
+        if router_download is not None and router_upload is not None:
+            rows.append((timestamp, *self.ROUTER_KEY, router_download, router_upload))
+
+        pack_into = self.RECORD.pack_into
+        with self.lock:
+            head = self.head
+            for row in rows:
+                pack_into(self.map, self._offset(head), *row)
+                head = (head + 1) % self.capacity
+            self.head = head
+            self.count = min(self.capacity, self.count + len(rows))
+            self._write_header()
+
+    def index(self, since=0, until=float('inf')):
+        """
+        Slots of the records with since < timestamp <= until, grouped by
+        (MAC, IP) key in time order: returns ({key: array of slots}, until).
+        until comes back capped at the newest record written so far, so a slot
+        overwritten after indexing is recognised by its newer timestamp.
+        """
+        with self.lock:
+            head, count = self.head, self.count
+            if not count:
+                return {}, until
+            until = min(until, self.read((head - 1) % self.capacity)[0])
+
+        # Oldest first: from head to the end of the file, then from the start
+        first = (head - count) % self.capacity
+        ranges = [(first, min(first + count, self.capacity)), (0, max(0, first + count - self.capacity))]
+        index = {}
+        for range_start, range_end in ranges:
+            for chunk_start in range(range_start, range_end, BACKFILL_CHUNK_RECORDS):
+                chunk_end = min(chunk_start + BACKFILL_CHUNK_RECORDS, range_end)
+                data = self.map[self._offset(chunk_start):self._offset(chunk_end)]
+                for slot, (timestamp, mac, ip, _, _) in enumerate(self.RECORD.iter_unpack(data), chunk_start):
+                    if since < timestamp <= until:
+                        slots = index.get((mac, ip))
+                        if slots is None:
+                            slots = index[(mac, ip)] = array('L')
+                        slots.append(slot)
+        return index, until
+
+    def read(self, slot):
+        """The record in a slot as (timestamp, mac, ip, download, upload)"""
+        return self.RECORD.unpack_from(self.map, self._offset(slot))
+
+    def oldest_timestamp(self):
+        """Timestamp of the oldest buffered sample, or None if the ring is empty"""
+        with self.lock:
+            if not self.count:
+                return None
+            oldest = self.head if self.count == self.capacity else 0
+            return self.read(oldest)[0]
+
+# Buffered values, exported under the same names as the live metrics
+BACKFILL_FAMILIES = [
+    ('opennds_client_download_bytes', 'counter', 'Client download this session in bytes', 3, False),
+    ('opennds_client_upload_bytes', 'counter', 'Client upload this session in bytes', 4, False),
+    ('opennds_router_download_bytes_total', 'gauge', 'Total router download', 3, True),
+    ('opennds_router_upload_bytes_total', 'gauge', 'Total router upload', 4, True)
+]
+
+def render_backfill(ring, since=0, until=float('inf')):
+    """
+    Yield buffered samples as OpenMetrics text with explicit timestamps, the
+    input promtool tsdb create-blocks-from openmetrics expects. Each series'
+    samples are contiguous and in time order; they are read back from the
+    ring a chunk at a time rather than copied out all at once.
+    """
+    index, until = ring.index(since, until)
+    labels = {key: f'{{mac="{key[0].hex(":")}",ip="{socket.inet_ntoa(key[1])}"}}'
+              for key in index if key != SampleRing.ROUTER_KEY}
+    labels[SampleRing.ROUTER_KEY] = ''
+    for name, metric_type, help_text, column, router in BACKFILL_FAMILIES:
+        yield f"# TYPE {name} {metric_type}\n# HELP {name} {help_text}\n"
+        sample_name = f"{name}_total" if metric_type == 'counter' else name
+        lines = []
+        for key, slots in sorted(index.items()):
+            if (key == SampleRing.ROUTER_KEY) != router:
+                continue
+            prefix = sample_name + labels[key]
+            for slot in slots:
+                sample = ring.read(slot)
+                # Skip slots the exporter has overwritten since they were indexed
+                if sample[0] <= until and sample[1:3] == key:
+                    lines.append(f"{prefix} {sample[column]!r} {sample[0]:.3f}\n")
+                    if len(lines) == BACKFILL_CHUNK_RECORDS:
+                        yield ''.join(lines)
+                        lines = []
+        yield ''.join(lines)
+    yield '# EOF\n'
+
+class SnapshotRefresher(threading.Thread):
+    """
+    Background thread that keeps the latest good snapshot ready for scrapes.
+    Scrapes never wait on ndsctl; they read whatever snapshot is current.
+    A failed or timed-out refresh keeps the previous snapshot and marks it stale.
+    Refreshing pauses when nothing has scraped for IDLE_TIMEOUT seconds, unless
+    samples are being buffered to a SampleRing for backfill: Prometheus being
+    down is exactly when those are needed.
+    After each refresh the registered ExpositionCaches render the new data,
+    so scrapes don't wait on rendering either.
+    """
+
+    def __init__(self, source, ring=None):
+        super().__init__(name='snapshot-refresher', daemon=True)
+        self.source = source
+        self.ring = ring
+        self.table = ClientTable()
+        self.snapshot = None
+        self.caches = []  # ExpositionCaches to re-render after each refresh
+        self.render_duration = 0  # Seconds the last re-render took
+        self.interval = REFRESH_INTERVAL
+        self.last_refresh_ok = False
+        self._last_scrape = time.monotonic()
+        self._scraped = threading.Event()
+        self._profile_next = False
+
+    def profile_next_refresh(self):
+        """Ask the thread to run its next refresh under cProfile"""
+        self._profile_next = True
+        self._scraped.set()
+
+    def notify_scrape(self):
+        """Record scrape activity, waking the thread if it is idle"""
+        self._last_scrape = time.monotonic()
+        self._scraped.set()
+
+    def is_idle(self):
+        """True if nothing has scraped for IDLE_TIMEOUT seconds"""
+        return time.monotonic() - self._last_scrape > IDLE_TIMEOUT
+
+    def render_caches(self):
+        """Render the exposition caches from the current data, unless nobody is scraping"""
+        if self.is_idle():
+            return
+        start = time.monotonic()
+        for cache in self.caches:
+            cache.render()
+        self.render_duration = time.monotonic() - start
+
+    def refresh(self):
+        """Collect one snapshot and adapt the interval to its cost and churn"""
+        start = time.monotonic()
+        data = get_nds_data(self.source)
+        duration = time.monotonic() - start
+
+        if data is None:
+            # Keep serving the last good snapshot; retry no sooner than the failed call took
+            self.last_refresh_ok = False
+            self.interval = min(MAX_REFRESH_INTERVAL, max(self.interval, duration))
+            self.render_caches()  # The staleness gauges changed
+            return
+
+        total_stats, clients_data = data
+        timestamp = time.time()
+        with UPDATE_DURATION.time(), self.table.lock:
+            churn = self.table.update(clients_data, timestamp)
+            self.snapshot = Snapshot(
+                timestamp=timestamp,
+                router_download=total_stats.get('total_download'),
+                router_upload=total_stats.get('total_upload')
+            )
+            if self.ring is not None:
+                self.ring.append(timestamp, self.table.records.values(),
+                                 self.snapshot.router_download, self.snapshot.router_upload)
+            self.last_refresh_ok = True
+        # Rendering is part of what each refresh costs
+        self.interval = self.next_interval(duration + self.render_duration, churn)
+        self.render_caches()
+
+    def next_interval(self, duration, churn):
+        """
+        Pick the next refresh interval.
+        Churn shortens the interval below REFRESH_INTERVAL, a quiet client table
+        lets it drift back up, and expensive collections push it out so the
+        exporter never spends more than 1/REFRESH_COST_FACTOR of its time collecting.
+        """
+        if churn > 0:
+            interval = REFRESH_INTERVAL / (1 + CHURN_WEIGHT * churn)
+        else:
+            interval = min(max(self.interval, REFRESH_INTERVAL), self.interval * 1.25)
+        interval = max(MIN_REFRESH_INTERVAL, min(MAX_REFRESH_INTERVAL, interval))
+        return max(interval, duration * REFRESH_COST_FACTOR)
+
+    def snapshot_age(self):
+        """Seconds since the current snapshot was collected, or None before the first one"""
+        if self.snapshot is None:
+            return None
+        return time.time() - self.snapshot.timestamp
+
+    def is_stale(self):
+        """True if the last refresh failed or the snapshot has outlived two intervals"""
+        age = self.snapshot_age()
+        return not self.last_refresh_ok or age is None or age > 2 * self.interval
+
+    def run(self):
+        while True:
+            if self.ring is None and self.is_idle():
+                # Nobody is scraping, so don't run ndsctl until someone does
+                self._scraped.wait()
+            self._scraped.clear()
+            if self._profile_next:
+                self._profile_next = False
+                self.profiled_refresh()
+            else:
+                self.refresh()
+            time.sleep(self.interval)
+
+    def profiled_refresh(self):
+        """Run one refresh under cProfile and write the stats to PROFILE_DIR"""
+        profiler = cProfile.Profile()
+        profiler.runcall(self.refresh)
+        path = os.path.join(PROFILE_DIR, f"opennds-exporter-{int(time.time())}.prof")
+        profiler.dump_stats(path)
+        print(f"Wrote refresh profile to {path}")
+
+class NDSCollector:
+    """
+    Prometheus collector that serves the refresher's latest snapshot.
+    Client records are read under the table lock, so a scrape never sees
+    a half-applied refresh.
+    """
+
+    def __init__(self, refresher):
+        self.refresher = refresher
+
+    def describe(self):
+        """Describe metrics without counting registration as a scrape"""
+        return self._families(None)
+
+    def collect(self):
+        if threading.current_thread() is not self.refresher:
+            self.refresher.notify_scrape()  # Renders for the exposition cache aren't scrapes
+        with self.refresher.table.lock:
+            return self._families(self.refresher.snapshot)
+
+    def _families(self, snapshot):
+        # Per-client values are numeric so rate() works and label sets stay stable
+        client_download = CounterMetricFamily('opennds_client_download_bytes',
+                                              'Client download this session in bytes', labels=['mac', 'ip'])
+        client_upload = CounterMetricFamily('opennds_client_upload_bytes',
+                                            'Client upload this session in bytes', labels=['mac', 'ip'])
+        client_state = GaugeMetricFamily('opennds_client_state',
+                                         'Client state (1 for the current state, 0 otherwise)',
+                                         labels=['mac', 'ip', 'state'])
+        client_info = GaugeMetricFamily('opennds_client_info', 'Static client details',
+                                        labels=['mac', 'ip', 'type'])
+        client_last_seen = GaugeMetricFamily('opennds_client_last_seen_timestamp_seconds',
+                                             'Unix time the client was last reported by ndsctl',
+                                             labels=['mac', 'ip'])
+        # Router-wide metrics remain as Gauges since they're single values
+        router_download = GaugeMetricFamily('opennds_router_download_bytes_total', 'Total router download')
+        router_upload = GaugeMetricFamily('opennds_router_upload_bytes_total', 'Total router upload')
+        # Throughput derived from each client's sample history
+        client_download_rate = GaugeMetricFamily('opennds_client_download_rate_bytes_per_second',
+                                                 'Current client download rate', labels=['mac', 'ip'])
+        client_upload_rate = GaugeMetricFamily('opennds_client_upload_rate_bytes_per_second',
+                                               'Current client upload rate', labels=['mac', 'ip'])
+        client_peak_download_rate = GaugeMetricFamily('opennds_client_peak_download_rate_bytes_per_second',
+                                                      'Peak client download rate over the recent sample window',
+                                                      labels=['mac', 'ip'])
+        client_peak_upload_rate = GaugeMetricFamily('opennds_client_peak_upload_rate_bytes_per_second',
+                                                    'Peak client upload rate over the recent sample window',
+                                                    labels=['mac', 'ip'])
+        top_talkers = GaugeMetricFamily('opennds_top_talker_rate_bytes_per_second',
+                                        f"Current rate of the top {TOP_TALKERS} clients by direction",
+                                        labels=['direction', 'rank', 'mac', 'ip'])
+        # Freshness of the data being served
+        snapshot_age = GaugeMetricFamily('opennds_exporter_snapshot_age_seconds',
+                                         'Seconds since the served snapshot was collected')
+        snapshot_stale = GaugeMetricFamily('opennds_exporter_snapshot_stale',
+                                           'Whether the served snapshot is stale (1) or fresh (0)')
+        refresh_interval = GaugeMetricFamily('opennds_exporter_refresh_interval_seconds',
+                                             'Current adaptive refresh interval')
+        client_count = GaugeMetricFamily('opennds_exporter_clients',
+                                         'Number of clients in the served snapshot')
+        buffer_oldest = GaugeMetricFamily('opennds_exporter_buffer_oldest_timestamp_seconds',
+                                          'Unix time of the oldest sample available from /backfill')
+
+        if snapshot is not None:
+            snapshot_age.add_metric([], self.refresher.snapshot_age())
+            client_count.add_metric([], len(self.refresher.table.records))
+        snapshot_stale.add_metric([], 1 if self.refresher.is_stale() else 0)
+        refresh_interval.add_metric([], self.refresher.interval)
+        if snapshot is not None and self.refresher.ring is not None:
+            oldest = self.refresher.ring.oldest_timestamp()
+            if oldest is not None:
+                buffer_oldest.add_metric([], oldest)
+
+        if snapshot is not None:
+            # Router totals are missing when the source doesn't report them
+            if snapshot.router_download is not None:
+                router_download.add_metric([], snapshot.router_download)
+            if snapshot.router_upload is not None:
+                router_upload.add_metric([], snapshot.router_upload)
+
+            # Only clients in the current snapshot are emitted, so series for
+            # departed clients end as soon as a refresh no longer reports them
+            clients = self.refresher.table.records.values()
+            for client in clients:
+                labels = [client.mac, client.ip]
+                client_download.add_metric(labels, client.download)
+                client_upload.add_metric(labels, client.upload)
+                client_info.add_metric(labels + [client.type], 1)
+                client_last_seen.add_metric(labels, client.last_seen)
+
+                states = CLIENT_STATES if client.state in CLIENT_STATES else CLIENT_STATES + (client.state,)
+                for state in states:
+                    client_state.add_metric(labels + [state], 1 if state == client.state else 0)
+
+                client_download_rate.add_metric(labels, client.download_rate)
+                client_upload_rate.add_metric(labels, client.upload_rate)
+                client_peak_download_rate.add_metric(labels, client.peak_download_rate)
+                client_peak_upload_rate.add_metric(labels, client.peak_upload_rate)
+
+            for direction in ('download', 'upload'):
+                rate_of = attrgetter(f"{direction}_rate")
+                for rank, client in enumerate(heapq.nlargest(TOP_TALKERS, clients, key=rate_of), 1):
+                    top_talkers.add_metric([direction, str(rank), client.mac, client.ip], rate_of(client))
+
+        return [client_download, client_upload, client_state, client_info, client_last_seen,
+                router_download, router_upload, client_download_rate, client_upload_rate,
+                client_peak_download_rate, client_peak_upload_rate, top_talkers,
+                snapshot_age, snapshot_stale, refresh_interval, client_count, buffer_oldest]
+
+def dump_allocations():
+    """
+    Toggle tracemalloc. The first call starts tracing; the next writes the
+    top allocation sites to PROFILE_DIR and stops tracing.
+    """
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+        print("Started allocation tracing")
+        return
+
+    stats = tracemalloc.take_snapshot().statistics('lineno')
+    tracemalloc.stop()
+    path = os.path.join(PROFILE_DIR, f"opennds-exporter-{int(time.time())}.mem.txt")
+    with open(path, 'w') as f:
+        for stat in stats[:50]:
+            f.write(f"{stat}\n")
+    print(f"Wrote allocation report to {path}")
+
+class ExpositionCache:
+    """
+    Rendered /metrics bodies, one per exposition format, with ETags. The
+    refresher re-renders and compresses every format in use right after each
+    refresh, so a scrape only picks a body. The text format and OpenMetrics
+    are always rendered; other variants (e.g. another escaping) from their
+    first request until nobody has asked for them for IDLE_TIMEOUT seconds.
+    A scrape only renders when there's no body yet, or when refreshing has
+    stalled for two intervals, so the freshness gauges keep moving.
+    """
+
+    def __init__(self, refresher, registry=REGISTRY):
+        self.refresher = refresher
+        self.registry = registry
+        self.entries = {}  # Content type -> CachedBody
+        # Content type -> (encoder, monotonic time last requested, or None to always render)
+        self.formats = {}
+        for accept in PRERENDERED_FORMATS:
+            encoder, content_type = choose_encoder(accept)
+            self.formats[content_type] = (encoder, None)
+        self.lock = threading.Lock()
+        refresher.caches.append(self)
+
+    def _render(self, encoder):
+        body = encoder(self.registry)
+        # Derived from the content, so ETags stay valid across exporter restarts
+        etag = f'"{hashlib.blake2b(body, digest_size=12).hexdigest()}"'
+        return CachedBody(time.monotonic(), body, gzip.compress(body, GZIP_LEVEL), etag)
+
+    def render(self):
+        """Re-render every format in use; called by the refresher"""
+        now = time.monotonic()
+        for content_type, (encoder, requested) in list(self.formats.items()):
+            if requested is not None and now - requested > IDLE_TIMEOUT:
+                self.formats.pop(content_type, None)
+                self.entries.pop(content_type, None)
+            else:
+                self.entries[content_type] = self._render(encoder)
+
+    def get(self, accept=None):
+        """Return (content type, CachedBody) for a scrape's Accept header"""
+        encoder, content_type = choose_encoder(accept)
+        if content_type not in self.formats or self.formats[content_type][1] is not None:
+            # Keep rendering this variant after refreshes while it's being requested
+            self.formats[content_type] = (encoder, time.monotonic())
+        entry = self.entries.get(content_type)
+        if entry is None or time.monotonic() - entry.rendered_at > 2 * self.refresher.interval:
+            # Concurrent scrapes wait here for one render
+            with self.lock:
+                entry = self.entries.get(content_type)
+                if entry is None or time.monotonic() - entry.rendered_at > 2 * self.refresher.interval:
+                    entry = self.entries[content_type] = self._render(encoder)
+        return content_type, entry
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+def make_exporter_app(refresher, registry=REGISTRY):
+    """WSGI app serving /metrics from the exposition cache and /backfill from the sample ring"""
+    cache = ExpositionCache(refresher, registry)
+    ring = refresher.ring
+
+    def metrics(environ, start_response):
+        refresher.notify_scrape()
+        content_type, entry = cache.get(environ.get('HTTP_ACCEPT'))
+        gzipped = 'gzip' in environ.get('HTTP_ACCEPT_ENCODING', '')
+        # Each encoding is a separate representation with its own strong ETag
+        etag = entry.etag[:-1] + '-gzip"' if gzipped else entry.etag
+        headers = [('ETag', etag), ('Vary', 'Accept, Accept-Encoding')]
+        if etag in (tag.strip() for tag in environ.get('HTTP_IF_NONE_MATCH', '').split(',')):
+            start_response('304 Not Modified', headers)
+            return []
+
+        body = entry.gzipped if gzipped else entry.body
+        headers += [('Content-Type', content_type), ('Content-Length', str(len(body)))]
+        if gzipped:
+            headers.append(('Content-Encoding', 'gzip'))
+        start_response('200 OK', headers)
+        return [body]
+
+    def backfill(environ, start_response):
+        if ring is None:
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return [b'Sample buffering is disabled\n']
+        query = parse_qs(environ.get('QUERY_STRING', ''))
+        try:
+            since = float(query.get('since', ['0'])[0])
+            until = float(query.get('until', ['inf'])[0])
+        except ValueError:
+            start_response('400 Bad Request', [('Content-Type', 'text/plain')])
+            return [b'since and until must be Unix timestamps\n']
+        start_response('200 OK', [('Content-Type', 'application/openmetrics-text; version=1.0.0; charset=utf-8')])
+        return (chunk.encode() for chunk in render_backfill(ring, since, until))
+
+    def app(environ, start_response):
+        if environ.get('PATH_INFO') == '/backfill':
+            return backfill(environ, start_response)
+        return metrics(environ, start_response)
+
+    return app
 
 def main():
     """
-    Main function to start the Prometheus metrics server and update loop.
+    Main function to register the collector and start the Prometheus metrics server.
     """
+    parser = argparse.ArgumentParser(description='Prometheus exporter for OpenNDS client data')
+    parser.add_argument('--source', choices=sorted(SOURCES), default='text',
+                        help='where client data is read from (default: text)')
+    parser.add_argument('--fixture', help='capture file or directory replayed by the file source')
+    parser.add_argument('--ring-file', default=RING_FILE,
+                        help=f"file buffering samples for /backfill, empty to disable (default: {RING_FILE})")
+    parser.add_argument('--ring-size', type=int, default=RING_SIZE // 1024, metavar='KIB',
+                        help=f"size of the ring file in KiB (default: {RING_SIZE // 1024})")
+    args = parser.parse_args()
+
+    if args.source == 'file':
+        if not args.fixture:
+            parser.error('--source file requires --fixture')
+        source = FileSource(args.fixture)
+    else:
+        source = SOURCES[args.source]()
+
+    # Snapshots are collected in the background; scrapes only read the latest one
+    ring = SampleRing(args.ring_file, args.ring_size * 1024) if args.ring_file else None
+    refresher = SnapshotRefresher(source, ring)
+    refresher.start()
+    REGISTRY.register(NDSCollector(refresher))
+
+    # Opt-in diagnostics: SIGUSR1 profiles one refresh, SIGUSR2 toggles allocation tracing
+    signal.signal(signal.SIGUSR1, lambda signum, frame: refresher.profile_next_refresh())
+    signal.signal(signal.SIGUSR2, lambda signum, frame: dump_allocations())
+
     # Start Prometheus HTTP server
-    start_http_server(9200)
+    server = make_server('', 9200, make_exporter_app(refresher), ThreadingWSGIServer, handler_class=QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
     print("Prometheus metrics available on port 9200")
     
     try:
-        # Main loop - update metrics every 15 seconds
-        while True:
-            update_metrics()
-            time.sleep(15)
+        # Serve from the HTTP server thread until interrupted
+        threading.Event().wait()
     except KeyboardInterrupt:
         print("\nExiting...")
 